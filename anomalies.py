@@ -0,0 +1,109 @@
+"""
+Anomaly detection on account activity.
+
+Author: Yakir Havin
+"""
+
+
+import polars as pl
+
+from constants import (
+    AnomalyRule,
+    Scenario,
+    ANOMALY_MIN_AMOUNT,
+    ANOMALY_MIN_HISTORY_MONTHS,
+    ANOMALY_SPIKE_RATIO,
+    ANOMALY_WINDOW_MONTHS,
+    ANOMALY_Z_SCORE
+)
+
+
+RULE_DTYPE = pl.Enum([rule.value for rule in AnomalyRule])
+
+ANOMALY_SCHEMA = {
+    "rule": RULE_DTYPE,
+    "entity": pl.Utf8,
+    "period": pl.Date,
+    "gl_account_code": pl.Utf8,
+    "gl_account_description": pl.Utf8,
+    "activity": pl.Float64,
+    "expected": pl.Float64,
+    "score": pl.Float64
+}
+
+
+def rule_flags(rule: AnomalyRule, expected: pl.Expr, score: pl.Expr, flagged: pl.Expr) -> list[pl.Expr]:
+    """Select the columns of a rule's anomalies from rows holding the activity it expected and its score."""
+    return [
+        pl.lit(rule.value, dtype=RULE_DTYPE).alias("rule"),
+        pl.col("entity"),
+        pl.col("period"),
+        pl.col("gl_account_code"),
+        pl.col("gl_account_description"),
+        pl.col("activity"),
+        expected.alias("expected"),
+        score.alias("score"),
+        (flagged & ((pl.col("activity") - expected).abs() >= ANOMALY_MIN_AMOUNT)).fill_null(False).alias("flagged")
+    ]
+
+
+def detect_anomalies(df: pl.DataFrame | pl.LazyFrame) -> pl.DataFrame:
+    """
+    Flag unusual activity of every account of every entity (as read by data_loader.read_trial_balance) in every period:
+    its z-score against the account's preceding ANOMALY_WINDOW_MONTHS, and its change from the prior month. Each
+    anomaly is a row with the activity, what was expected (the rolling mean or the prior month's activity) and the
+    score (the z-score or the change as a ratio of the prior month's activity).
+    Both rules are rolling windows over each account's periods, computed for all accounts at once. The z-score window
+    spans calendar months, so an account's activity from before a gap in its periods drops out of it.
+    """
+    account = ["entity", "gl_account_code"]
+    window = {"window_size": f"{ANOMALY_WINDOW_MONTHS}mo", "min_samples": ANOMALY_MIN_HISTORY_MONTHS, "closed": "left"}
+    lf = df.lazy().select(
+        pl.col("entity", "gl_account_code", "gl_account_description").cast(pl.Utf8),
+        "period",
+        pl.col("activity").cast(pl.Float64)
+    ).sort(*account, "period").with_columns(
+        pl.col("activity").rolling_mean_by("period", **window).over(account).alias("mean"),
+        pl.col("activity").rolling_std_by("period", **window).over(account).alias("std"),
+        # The prior month's activity, null when the account has no row for it
+        pl.when(pl.col("period").shift(1).over(account) == pl.col("period").dt.offset_by("-1mo")).then(
+            pl.col("activity").shift(1).over(account)
+        ).alias("prior")
+    ).with_columns(
+        ((pl.col("activity") - pl.col("mean")) / pl.when(pl.col("std") > 0).then(pl.col("std"))).alias("z_score"),
+        ((pl.col("activity") - pl.col("prior")) / pl.when(pl.col("prior") != 0).then(pl.col("prior").abs())).alias("change")
+    )
+
+    anomalies = [
+        lf.select(rule_flags(AnomalyRule.Z_SCORE, pl.col("mean"), pl.col("z_score"), pl.col("z_score").abs() > ANOMALY_Z_SCORE)),
+        lf.select(rule_flags(AnomalyRule.SPIKE, pl.col("prior"), pl.col("change"), pl.col("change").abs() > ANOMALY_SPIKE_RATIO))
+    ]
+    return pl.concat([rule.filter(pl.col("flagged")).drop("flagged") for rule in anomalies]).sort(
+        "period", "rule", "entity", "gl_account_code", descending=[True, False, False, False]
+    ).collect()
+
+
+def summarize_anomalies(anomalies: pl.DataFrame) -> pl.DataFrame:
+    """Count the anomalies of each rule with the number of accounts they affect."""
+    return anomalies.group_by("rule").agg(
+        pl.len().alias("anomalies"),
+        pl.col("gl_account_code").n_unique().alias("accounts")
+    ).sort("rule")
+
+
+def flag_cells(statement_df: pl.DataFrame, anomalies: pl.DataFrame) -> pl.DataFrame:
+    """
+    Flag the cells of a statement (as built by statements.build_statement) whose account had an anomaly in their
+    period, as a frame of booleans shaped like the statement without its is_subtotal column. Statements comparing
+    scenarios flag the actual amount of accounts with an anomaly anywhere in their range.
+    """
+    codes = statement_df["gl_account_code"].cast(pl.Utf8)
+    codes_by_column = {
+        period.isoformat(): pl.Series(accounts, dtype=pl.Utf8)
+        for period, accounts in anomalies.group_by("period").agg(pl.col("gl_account_code").unique()).iter_rows()
+    }
+    codes_by_column[Scenario.ACTUAL.value] = anomalies["gl_account_code"].unique()
+    return pl.DataFrame({
+        column: codes.is_in(codes_by_column.get(column, pl.Series(dtype=pl.Utf8))).fill_null(False)
+        for column in statement_df.columns if column != "is_subtotal"
+    })
@@ -6,9 +6,18 @@ Author: Yakir Havin
 
 import streamlit as st
 
+import data_loader
+from constants import ADMIN_PASSWORD, PLAN_SCENARIOS, SCENARIO_LOCATIONS
+
 
 st.logo("assets/contourcfo_logo.png")
 
+# Ingest new trial balances (and budgets and forecasts) in the background so reruns only ever read a complete snapshot
+data_loader.start_refresher()
+for scenario in PLAN_SCENARIOS:
+    if data_loader.scenario_available(scenario):
+        data_loader.start_refresher(**SCENARIO_LOCATIONS[scenario])
+
 
 def login():
     st.set_page_config(
@@ -30,6 +39,13 @@ def login():
 
         submitted = password_form.form_submit_button("Submit")
         if submitted:
+            if ADMIN_PASSWORD and password == ADMIN_PASSWORD:
+                st.session_state["logged_in"] = True
+                st.session_state["is_admin"] = True
+                st.success("Logged in successfully.")
+                password_form_container.empty()
+                st.rerun()
+
             try:
                 int(password)
             except ValueError:
@@ -0,0 +1,209 @@
+"""
+Headless benchmarks for each page's compute path, run against a synthetic trial balance.
+
+Usage:
+    python benchmark.py --accounts 5000 --periods 120 --entities 50 --output results.json
+    python benchmark.py --baseline results.json
+
+Each compute path runs in its own process so peak memory is reported per path. Results are
+written as JSON; pass a previous results file as --baseline to print the change in timings.
+
+Author: Yakir Havin
+"""
+
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+import numpy as np
+import polars as pl
+
+
+ACCOUNT_DESCRIPTIONS = {
+    1: "Asset",
+    2: "Liability",
+    3: "Equity",
+    4: "Revenue",
+    5: "Cost of Goods Sold",
+    6: "Operating Expense",
+    7: "Operating Expense",
+    8: "Operating Expense",
+    9: "Operating Expense"
+}
+
+PATHS = [
+    "ingest",
+    "metrics_section",
+    "performance_explorer_section",
+    "income_statement_section",
+    "balance_sheet_section",
+    "cash_flow_statement_section"
+]
+
+
+def generate_trial_balance(accounts: int=24, periods: int=13, entities: int=1, start: date=date(2015, 1, 1), seed: int=0) -> pl.DataFrame:
+    """
+    Generate a trial balance shaped like data/trial_balance.csv, with GL codes spread evenly over 1000-9999.
+    An entity column is added when there is more than one entity.
+    """
+    if not 1 <= accounts <= 9000:
+        raise ValueError("accounts must be between 1 and 9000")
+
+    rng = np.random.default_rng(seed)
+    codes = (1000 + np.arange(accounts) * 9000 // accounts).astype(str)
+    rows = entities * accounts * periods
+
+    debit = rng.integers(0, 100_000, rows).astype(float)
+    credit = rng.integers(0, 100_000, rows).astype(float)
+
+    df = pl.DataFrame({
+        "entity": np.repeat([f"E{entity:03d}" for entity in range(entities)], accounts * periods),
+        "gl_account_code": np.tile(np.repeat(codes, periods), entities),
+        "period": np.tile(np.arange(periods), entities * accounts),
+        "debit": debit,
+        "credit": credit,
+        "opening": np.repeat(rng.integers(0, 1_000_000, entities * accounts).astype(float), periods)
+    }).with_columns(
+        pl.date(start.year, start.month, 1).dt.offset_by(pl.format("{}mo", pl.col("period"))).alias("period"),
+        pl.col("gl_account_code").str.slice(0, 1).cast(pl.Int64).replace_strict(ACCOUNT_DESCRIPTIONS).alias("gl_account_description"),
+        (pl.col("debit") - pl.col("credit")).alias("activity")
+    ).with_columns(
+        (pl.col("opening") + pl.col("activity").cum_sum().over("entity", "gl_account_code")).alias("closing_balance")
+    ).with_columns(
+        pl.format("{} {}", pl.col("gl_account_description"), pl.col("gl_account_code")).alias("gl_account_description"),
+        (pl.col("closing_balance") - pl.col("activity")).alias("beginning_balance")
+    ).sort("period", "entity", "gl_account_code")
+
+    columns = ["period", "gl_account_code", "gl_account_description", "beginning_balance", "debit", "credit", "closing_balance", "activity"]
+    return df.select((["entity"] if entities > 1 else []) + columns)
+
+
+def compute_paths(periods: list[date], range_periods: int) -> dict:
+    """Return the compute path of each page section, as callables taking no arguments."""
+    # Imported here so workers pick up the data locations set in the environment
+    import charts
+    import data_loader
+    import metrics
+    import shared_cache
+    import statements
+    from constants import Metric, MetricBasis, Statement
+
+    from_period, to_period = periods[-min(range_periods, len(periods))], periods[-1]
+
+    def statement_path(statement):
+        def path():
+            shared_cache.clear()
+            return statements.build_statement(statement, from_period, to_period, data_loader.data_version())
+        return path
+
+    def chart_path():
+        shared_cache.clear()
+        return charts.build_metric_chart((Metric.REVENUE, Metric.NET_PROFIT), from_period, to_period, MetricBasis.MONTH, True, None, data_loader.data_version())
+
+    return {
+        "metrics_section": lambda: metrics.summarize_period(data_loader.scan_rollup(), to_period),
+        "performance_explorer_section": chart_path,
+        "income_statement_section": statement_path(Statement.INCOME_STATEMENT),
+        "balance_sheet_section": statement_path(Statement.BALANCE_SHEET),
+        "cash_flow_statement_section": statement_path(Statement.CASH_FLOW_STATEMENT)
+    }
+
+
+def run_path(name: str, repeats: int, range_periods: int) -> dict:
+    """Time one compute path in the current process (meant to be a fresh worker process)."""
+    import data_loader
+
+    baseline_rss = peak_rss_mb()
+    if name == "ingest":
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            data_loader.ingest_trial_balance(store=tempfile.mkdtemp(prefix="store-", dir=os.path.dirname(data_loader.TRIAL_BALANCE_STORE_PATH)))
+            timings.append(time.perf_counter() - start)
+        data_loader.current_snapshot()
+    else:
+        path = compute_paths(data_loader.fetch_periods(), range_periods)[name]
+        path()  # Warm up so imports and the first memory-mapping aren't timed
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            path()
+            timings.append(time.perf_counter() - start)
+
+    return {
+        "path": name,
+        "seconds": {"min": min(timings), "median": statistics.median(timings), "max": max(timings)},
+        "baseline_rss_mb": baseline_rss,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--accounts", type=int, default=500)
+    parser.add_argument("--periods", type=int, default=36)
+    parser.add_argument("--entities", type=int, default=1)
+    parser.add_argument("--range-periods", type=int, default=12, help="Periods selected on the statement and explorer pages")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write results to this JSON file instead of stdout")
+    parser.add_argument("--baseline", help="Previous results JSON to compare against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as directory:
+        # Workers read the synthetic ledger through the app's own loader defaults
+        os.environ["TRIAL_BALANCE_PATH"] = os.path.join(directory, "trial_balance.csv")
+        os.environ["TRIAL_BALANCE_STORE_PATH"] = os.path.join(directory, "store", "trial_balance")
+
+        df = generate_trial_balance(args.accounts, args.periods, args.entities, seed=args.seed)
+        df.write_csv(os.environ["TRIAL_BALANCE_PATH"])
+        os.makedirs(os.path.dirname(os.environ["TRIAL_BALANCE_STORE_PATH"]))
+
+        results = []
+        for name in PATHS:
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                result = pool.apply(run_path, (name, args.repeats, args.range_periods))
+            results.append(result)
+            print(f"{name:<30} {result['seconds']['median'] * 1000:>10.1f} ms  {result['peak_rss_mb']:>8.0f} MB peak", file=sys.stderr)
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "polars": pl.__version__,
+        "parameters": {**vars(args), "rows": df.height},
+        "results": results
+    }
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = {result["path"]: result for result in json.load(file)["results"]}
+        for result in results:
+            if result["path"] in baseline:
+                ratio = result["seconds"]["median"] / baseline[result["path"]]["seconds"]["median"]
+                result["baseline_ratio"] = ratio
+                print(f"{result['path']:<30} {ratio:>6.2f}x baseline", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Chart builders.
+
+Author: Yakir Havin
+"""
+
+
+from datetime import date
+
+import altair as alt
+import polars as pl
+
+import data_loader
+import metrics
+import shared_cache
+from constants import (
+    Granularity,
+    Metric,
+    MetricBasis,
+    Scenario,
+    CHART_MAX_POINTS,
+    GRANULARITY_CONSTANTS,
+    METRIC_CONSTANTS
+)
+
+
+CHART_DATASET = "metrics"
+
+
+def chart_granularity(from_period: date, to_period: date) -> Granularity:
+    """Return the finest granularity that plots a period range (inclusive) in at most CHART_MAX_POINTS points."""
+    months = (to_period.year - from_period.year) * 12 + to_period.month - from_period.month + 1
+    for granularity in Granularity:
+        if months <= CHART_MAX_POINTS * GRANULARITY_CONSTANTS[granularity]["months"]:
+            return granularity
+    return Granularity.YEAR
+
+
+def build_metric_chart(metric_selection: tuple[Metric, ...], from_period: date, to_period: date, basis: MetricBasis,
+                       prior_year: bool, entities: tuple[str, ...] | None, data_version: str | tuple[str, ...],
+                       scenario: Scenario | None=None) -> dict:
+    """
+    Build the performance explorer's Vega-Lite spec, with its data, memoized per data version in the shared cache
+    (the versions of both stores, data_loader.scenario_versions, when comparing with a budget or forecast scenario).
+    Specs are shared across sessions so callers must not mutate them (st.vega_lite_chart only reads its argument).
+    """
+    return shared_cache.get_or_compute(
+        "charts",
+        (metric_selection, from_period, to_period, basis, prior_year, entities, scenario),
+        data_version,
+        lambda: metric_chart_spec(metric_selection, from_period, to_period, basis, prior_year, entities, scenario)
+    )
+
+
+def metric_chart_spec(metric_selection: tuple[Metric, ...], from_period: date, to_period: date, basis: MetricBasis,
+                      prior_year: bool, entities: tuple[str, ...] | None, scenario: Scenario | None=None) -> dict:
+    """
+    Build the performance explorer's Vega-Lite spec, with its data.
+    All metrics share one dataset; metrics with another format (ratios next to amounts) get their own y axis.
+    A budget or forecast scenario is aggregated with the actuals and plotted as its own series, with the variance
+    in the tooltips.
+    """
+    granularity = chart_granularity(from_period, to_period)
+    scenarios = [Scenario.ACTUAL] if scenario is None else [Scenario.ACTUAL, scenario]
+    lf = data_loader.scan_scenarios(data_loader.scan_rollup, scenarios, entities)
+    df = metrics.metric_series(lf, list(metric_selection), from_period, to_period, basis, granularity, scenario)
+
+    # One line per metric and series: the metric on the selected basis and, optionally, the same periods a year earlier
+    # and the plan
+    series = {"value": basis.value}
+    if prior_year:
+        series["prior_year_value"] = "Prior year"
+    if scenario is not None:
+        series["plan_value"] = scenario.value
+    index = ["period", "metric"] if scenario is None else ["period", "metric", "variance", "variance_ratio"]
+    df = df.unpivot(index=index, on=list(series), variable_name="series", value_name="amount").with_columns(
+        pl.col("series").replace_strict(series)
+    )
+
+    time_format = GRANULARITY_CONSTANTS[granularity]["format"]
+    formats = {}
+    for metric in metric_selection:
+        formats.setdefault(METRIC_CONSTANTS[metric]["format"]["axis"], []).append(metric)
+
+    layers = [
+        alt.Chart().mark_line(point=True).encode(
+            x=alt.X(
+                f"{GRANULARITY_CONSTANTS[granularity]['time_unit']}(period):T",
+                title=None,
+                axis=alt.Axis(
+                    format=time_format,
+                    labelAngle=-45,
+                    labelAlign="right",
+                    labelOverlap=False
+                ),
+            ),
+            y=alt.Y(
+                "amount:Q",
+                title=None,
+                axis=alt.Axis(format=axis_format)
+            ),
+            color=alt.Color(
+                "metric:N",
+                title=None,
+                sort=[metric.value for metric in metric_selection],
+                legend=alt.Legend(orient="bottom") if len(metric_selection) > 1 else None
+            ),
+            strokeDash=alt.StrokeDash(
+                "series:N",
+                title=None,
+                sort=list(series.values()),
+                legend=alt.Legend(orient="bottom") if len(series) > 1 else None
+            ),
+            tooltip=[
+                alt.Tooltip("period:T", title=granularity.value, format=time_format),
+                alt.Tooltip("metric:N", title="Metric"),
+                alt.Tooltip("series:N", title="Series"),
+                alt.Tooltip("amount:Q", title="Value", format=METRIC_CONSTANTS[layer_metrics[0]]["format"]["tooltip"]),
+                *([] if scenario is None else [
+                    alt.Tooltip("variance:Q", title=f"Variance from {scenario.value.lower()}", format=METRIC_CONSTANTS[layer_metrics[0]]["format"]["tooltip"]),
+                    alt.Tooltip("variance_ratio:Q", title="Variance %", format=".1%")
+                ])
+            ]
+        ).transform_filter(
+            alt.FieldOneOfPredicate(field="metric", oneOf=[metric.value for metric in layer_metrics])
+        )
+        for axis_format, layer_metrics in formats.items()
+    ]
+
+    chart = alt.layer(*layers, data=alt.NamedData(CHART_DATASET))
+    if len(layers) > 1:
+        chart = chart.resolve_scale(y="independent")
+
+    spec = chart.to_dict()
+    spec.pop("config")  # Streamlit sizes and themes the chart itself
+    spec["datasets"] = {CHART_DATASET: df}
+    return spec
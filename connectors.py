@@ -0,0 +1,278 @@
+"""
+Trial balance sources.
+
+A source is named by a string: a CSV file, a directory of CSV and Parquet files (read recursively)
+or a database URL, sqlite:///path or duckdb:///path with an optional ?table= (TRIAL_BALANCE_TABLE by
+default). Relative paths follow the SQLAlchemy convention, so sqlite:////srv/ledger.db is absolute.
+Connectors read the trial balance with period range and account class filters pushed down to the
+source, and identify its contents cheaply so unchanged sources are never read.
+
+Database sources are incremental: periods before the latest one already ingested (the high-water
+mark) are closed, so only that period and newer ones are pulled and checked for changes. Queries
+run on connections from a pool per source.
+
+Author: Yakir Havin
+"""
+
+
+import hashlib
+import os
+import queue
+import re
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+from typing import Callable
+from urllib.parse import parse_qs, quote, urlsplit
+
+import polars as pl
+
+from constants import (
+    AccountClass,
+    CHART_OF_ACCOUNTS,
+    CONNECTION_POOL_SIZE,
+    DATABASE_BATCH_ROWS,
+    DEFAULT_ENTITY,
+    TRIAL_BALANCE_TABLE
+)
+
+
+TRIAL_BALANCE_SCHEMA = {
+    "entity": pl.Utf8,
+    "period": pl.Date,
+    "gl_account_code": pl.Utf8,
+    "gl_account_description": pl.Utf8,
+    "beginning_balance": pl.Float64,
+    "debit": pl.Float64,
+    "credit": pl.Float64,
+    "closing_balance": pl.Float64,
+    "activity": pl.Float64
+}
+
+FILE_EXTENSIONS = (".csv", ".parquet")
+
+# How each database dialect casts account codes (unparseable codes must not fail the query) and binds dates
+DIALECTS = {
+    "sqlite": {"integer_cast": "CAST", "date": date.isoformat},
+    "duckdb": {"integer_cast": "TRY_CAST", "date": lambda value: value}
+}
+
+_connectors: dict[str, "Connector"] = {}
+_connectors_lock = threading.Lock()
+
+
+def conform(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """Select the trial balance columns in TRIAL_BALANCE_SCHEMA order and types, assigning DEFAULT_ENTITY where there is none."""
+    schema = lf.collect_schema()
+    if "entity" not in schema:
+        lf = lf.with_columns(pl.lit(DEFAULT_ENTITY).alias("entity"))
+    period = pl.col("period").str.to_date() if schema["period"] == pl.Utf8 else pl.col("period").cast(pl.Date)
+    return lf.select(
+        period if column == "period" else pl.col(column).cast(dtype)
+        for column, dtype in TRIAL_BALANCE_SCHEMA.items()
+    ).with_columns(pl.col("entity").fill_null(DEFAULT_ENTITY))
+
+
+def account_class_ranges(account_classes: list[AccountClass]) -> list[tuple[int, int]]:
+    """Return the inclusive GL account code ranges of some account classes."""
+    return [code_range for account_class in account_classes for code_range in CHART_OF_ACCOUNTS[account_class]]
+
+
+class Connector(ABC):
+    """A trial balance source."""
+    incremental = False  # Whether closed periods are kept from the store and only the rest pulled
+
+    def __init__(self, source: str):
+        self.location = source
+
+    @abstractmethod
+    def exists(self) -> bool:
+        """Return whether the source is there to be read."""
+
+    @abstractmethod
+    def version(self, since: date | None=None) -> str:
+        """Identify the contents of the source (from a period on, for incremental sources) without reading it."""
+
+    @abstractmethod
+    def modified_at(self) -> datetime:
+        """Return when the source was last modified (timezone-aware, UTC)."""
+
+    @abstractmethod
+    def scan(self, from_period: date | None=None, to_period: date | None=None,
+             account_classes: list[AccountClass] | None=None) -> pl.LazyFrame:
+        """Read the trial balance for a period range (inclusive) and some account classes (all by default), conformed."""
+
+    def high_water_mark(self) -> date | None:
+        """Return the latest period in the source, from which incremental sources are pulled next."""
+        return None
+
+
+class FileConnector(Connector):
+    """A CSV file, or a directory of CSV and Parquet files."""
+
+    def __init__(self, source: str):
+        super().__init__(os.path.abspath(source))
+
+    def files(self) -> list[str]:
+        if not os.path.isdir(self.location):
+            return [self.location]
+        return sorted(
+            os.path.join(directory, file_name)
+            for directory, _, file_names in os.walk(self.location)
+            for file_name in file_names if file_name.endswith(FILE_EXTENSIONS)
+        )
+
+    def exists(self) -> bool:
+        return os.path.exists(self.location)
+
+    def version(self, since: date | None=None) -> str:
+        """Identify the contents of the source by modification time and size."""
+        stats = [(os.path.relpath(path, self.location), os.stat(path)) for path in self.files()]
+        if len(stats) == 1 and not os.path.isdir(self.location):
+            return f"{stats[0][1].st_mtime_ns}-{stats[0][1].st_size}"
+        return hashlib.md5(repr([(path, stat.st_mtime_ns, stat.st_size) for path, stat in stats]).encode()).hexdigest()[:12]
+
+    def modified_at(self) -> datetime:
+        return datetime.fromtimestamp(max(os.stat(path).st_mtime for path in self.files()), tz=timezone.utc)
+
+    def scan(self, from_period: date | None=None, to_period: date | None=None,
+             account_classes: list[AccountClass] | None=None) -> pl.LazyFrame:
+        """Scan the files lazily, so the filters reach the readers (Parquet row groups outside them are skipped)."""
+        lf = pl.concat([
+            conform(pl.scan_parquet(path) if path.endswith(".parquet") else pl.scan_csv(path, schema_overrides=TRIAL_BALANCE_SCHEMA))
+            for path in self.files()
+        ])
+        if from_period is not None:
+            lf = lf.filter(pl.col("period") >= from_period)
+        if to_period is not None:
+            lf = lf.filter(pl.col("period") <= to_period)
+        if account_classes is not None:
+            code = pl.col("gl_account_code").cast(pl.Int64, strict=False)
+            lf = lf.filter(pl.any_horizontal(pl.lit(False), *[code.is_between(low, high) for low, high in account_class_ranges(account_classes)]))
+        return lf
+
+
+class ConnectionPool:
+    """A bounded pool of connections to a database, shared by the threads reading it."""
+
+    def __init__(self, connect: Callable, size: int=CONNECTION_POOL_SIZE):
+        self._connect = connect
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection, waiting while all are in use. Connections that fail are closed rather than reused."""
+        with self._slots:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = self._connect()
+            try:
+                yield connection
+            except Exception:
+                connection.close()
+                raise
+            self._idle.put(connection)
+
+
+class DatabaseConnector(Connector):
+    """A trial balance table in a SQLite or DuckDB database, opened read only."""
+    incremental = True
+
+    def __init__(self, source: str):
+        super().__init__(source)
+        url = urlsplit(source)
+        self.dialect = DIALECTS[url.scheme]
+        self.scheme = url.scheme
+        self.path = url.path[1:]
+        self.table = parse_qs(url.query).get("table", [TRIAL_BALANCE_TABLE])[0]
+        if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?", self.table):
+            raise ValueError(f"Invalid table name: {self.table}")
+        self.pool = ConnectionPool(self.connect)
+
+    def connect(self):
+        if self.scheme == "duckdb":
+            import duckdb  # Only needed for DuckDB sources
+            return duckdb.connect(self.path, read_only=True)
+        # Connections are pooled across threads, and each is only used by one thread at a time
+        return sqlite3.connect(f"file:{quote(os.path.abspath(self.path))}?mode=ro", uri=True, check_same_thread=False)
+
+    def query(self, sql: str, parameters: list, schema: dict | None=None) -> pl.DataFrame:
+        """
+        Read the result of a query straight into columns: DuckDB hands it over as Arrow, and SQLite rows are fetched
+        DATABASE_BATCH_ROWS at a time into frames of the schema (where given), rather than as one list of Python rows.
+        """
+        with self.pool.connection() as connection:
+            if self.scheme == "duckdb":
+                return connection.execute(sql, parameters).pl()
+            batches = list(pl.read_database(
+                sql,
+                connection,
+                iter_batches=True,
+                batch_size=DATABASE_BATCH_ROWS,
+                schema_overrides=schema,
+                execute_options={"parameters": parameters}
+            ))
+            return pl.concat(batches) if batches else pl.DataFrame(schema=schema)
+
+    def columns(self) -> list[str]:
+        with self.pool.connection() as connection:
+            cursor = connection.execute(f"SELECT * FROM {self.table} LIMIT 0")
+            return [column[0] for column in cursor.description]
+
+    def where(self, from_period: date | None=None, to_period: date | None=None,
+              account_classes: list[AccountClass] | None=None) -> tuple[str, list]:
+        """Build the WHERE clause (with its parameters) of the filters, so the database applies them."""
+        conditions, parameters = [], []
+        if from_period is not None:
+            conditions.append("period >= ?")
+            parameters.append(self.dialect["date"](from_period))
+        if to_period is not None:
+            conditions.append("period <= ?")
+            parameters.append(self.dialect["date"](to_period))
+        if account_classes is not None:
+            code_ranges = account_class_ranges(account_classes)
+            code = f"{self.dialect['integer_cast']}(gl_account_code AS INTEGER)"
+            conditions.append(f"({' OR '.join([f'{code} BETWEEN ? AND ?'] * len(code_ranges)) or '1 = 0'})")
+            parameters.extend(bound for code_range in code_ranges for bound in code_range)
+        return (f" WHERE {' AND '.join(conditions)}" if conditions else ""), parameters
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def version(self, since: date | None=None) -> str:
+        """Identify the contents of the source from a period on by the count, latest period and totals of its rows."""
+        where, parameters = self.where(since)
+        row = self.query(f"SELECT COUNT(*), MAX(period), SUM(debit), SUM(credit), SUM(closing_balance) FROM {self.table}{where}", parameters).row(0)
+        return hashlib.md5(repr(row).encode()).hexdigest()[:12]
+
+    def modified_at(self) -> datetime:
+        """Databases don't expose when a table last changed, so this is when it was read."""
+        return datetime.now(timezone.utc)
+
+    def high_water_mark(self) -> date | None:
+        latest = self.query(f"SELECT MAX(period) FROM {self.table}", []).item()
+        return date.fromisoformat(str(latest)[:10]) if latest is not None else None
+
+    def scan(self, from_period: date | None=None, to_period: date | None=None,
+             account_classes: list[AccountClass] | None=None) -> pl.LazyFrame:
+        """Query only the rows within the filters."""
+        columns = self.columns()
+        where, parameters = self.where(from_period, to_period, account_classes)
+        # SQLite stores periods as text, which conform parses
+        schema = {
+            column: pl.Utf8 if column == "period" else dtype
+            for column, dtype in TRIAL_BALANCE_SCHEMA.items() if column in columns
+        }
+        return conform(self.query(f"SELECT {', '.join(schema)} FROM {self.table}{where}", parameters, schema).lazy())
+
+
+def connect(source: str) -> Connector:
+    """Return the connector of a source, created once per process so database connections are pooled across reads."""
+    with _connectors_lock:
+        if source not in _connectors:
+            _connectors[source] = DatabaseConnector(source) if urlsplit(source).scheme in DIALECTS else FileConnector(source)
+        return _connectors[source]
@@ -5,9 +5,16 @@ Author: Yakir Havin
 """
 
 
+import os
 from enum import Enum
 
 
+class Statement(Enum):
+    INCOME_STATEMENT = "Income Statement"
+    BALANCE_SHEET = "Balance Sheet"
+    CASH_FLOW_STATEMENT = "Cash Flow Statement"
+
+
 class IncomeStatementCategory(Enum):
     TOTAL_REVENUE = "Total Revenue"
     TOTAL_COST_OF_GOODS_SOLD = "Total Cost of Goods Sold"
@@ -22,6 +29,28 @@ class BalanceSheetCategory(Enum):
     TOTAL_EQUITY = "Total Equity"
 
 
+class CashFlowCategory(Enum):
+    NET_CASH_FROM_OPERATING_ACTIVITIES = "Net Cash from Operating Activities"
+    NET_CASH_FROM_INVESTING_ACTIVITIES = "Net Cash from Investing Activities"
+    NET_CASH_FROM_FINANCING_ACTIVITIES = "Net Cash from Financing Activities"
+    NET_CHANGE_IN_CASH = "Net Change in Cash"
+
+
+class CashFlowActivity(Enum):
+    OPERATING = "Operating"
+    INVESTING = "Investing"
+    FINANCING = "Financing"
+
+
+class AccountClass(Enum):
+    ASSET = "Asset"
+    LIABILITY = "Liability"
+    EQUITY = "Equity"
+    REVENUE = "Revenue"
+    COST_OF_GOODS_SOLD = "Cost of Goods Sold"
+    OPERATING_EXPENSES = "Operating Expenses"
+
+
 class Metric(Enum):
     REVENUE = "Revenue"
     GROSS_PROFIT = "Gross Profit"
@@ -31,6 +60,49 @@ class Metric(Enum):
     OPERATING_EXPENSE_RATIO = "Operating Expense Ratio"
 
 
+class MetricBasis(Enum):
+    MONTH = "Month"
+    YEAR_TO_DATE = "Year to date"
+    TRAILING_TWELVE_MONTHS = "Trailing twelve months"
+
+
+class Comparison(Enum):
+    PRIOR_MONTH = "Prior month"
+    PRIOR_YEAR = "Prior year"
+    BUDGET = "Budget"
+    FORECAST = "Forecast"
+
+
+class Scenario(Enum):
+    ACTUAL = "Actual"
+    BUDGET = "Budget"
+    FORECAST = "Forecast"
+
+
+class Granularity(Enum):
+    MONTH = "Month"
+    QUARTER = "Quarter"
+    YEAR = "Year"
+
+
+class ValidationRule(Enum):
+    CLOSING_BALANCE = "Closing balance equals beginning balance plus activity"
+    ACTIVITY = "Activity equals debits minus credits"
+    BALANCED_PERIOD = "Debits equal credits in each period"
+    CLASSIFIED_ACCOUNT = "Account code is in the chart of accounts"
+
+
+class AnomalyRule(Enum):
+    Z_SCORE = "Unusual activity"
+    SPIKE = "Month-over-month spike"
+
+
+class ExportFormat(Enum):
+    EXCEL = "Excel"
+    CSV = "CSV"
+    PARQUET = "Parquet"
+
+
 METRIC_CONSTANTS = {
     Metric.REVENUE: {
         "format": {
@@ -74,4 +146,256 @@ METRIC_CONSTANTS = {
         },
         "caption": "Operating expenses divided by revenue"
     }
-}
\ No newline at end of file
+}
+
+
+COMPARISON_MONTHS = {
+    Comparison.PRIOR_MONTH: 1,
+    Comparison.PRIOR_YEAR: 12
+}
+
+# Comparisons with a plan rather than an earlier period
+COMPARISON_SCENARIOS = {
+    Comparison.BUDGET: Scenario.BUDGET,
+    Comparison.FORECAST: Scenario.FORECAST
+}
+
+PLAN_SCENARIOS = [Scenario.BUDGET, Scenario.FORECAST]
+
+TRAILING_MONTHS = 12
+
+GRANULARITY_CONSTANTS = {
+    Granularity.MONTH: {
+        "months": 1,
+        "every": "1mo",
+        "time_unit": "yearmonth",
+        "format": "%B %Y"
+    },
+    Granularity.QUARTER: {
+        "months": 3,
+        "every": "1q",
+        "time_unit": "yearquarter",
+        "format": "Q%q %Y"
+    },
+    Granularity.YEAR: {
+        "months": 12,
+        "every": "1y",
+        "time_unit": "year",
+        "format": "%Y"
+    }
+}
+
+# Charts plot at most this many periods per series; longer ranges are aggregated to quarters, then years
+CHART_MAX_POINTS = 60
+
+
+EXPORT_CONSTANTS = {
+    ExportFormat.EXCEL: {
+        "extension": "xlsx",
+        "mime": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    },
+    ExportFormat.CSV: {
+        "extension": "csv",
+        "mime": "text/csv"
+    },
+    ExportFormat.PARQUET: {
+        "extension": "parquet",
+        "mime": "application/vnd.apache.parquet"
+    }
+}
+
+# Exports are written this many rows at a time, to a temporary file that moves to disk once it outgrows memory
+EXPORT_CHUNK_ROWS = 10_000
+EXPORT_SPOOL_MAX_BYTES = 16 * 1024 * 1024
+
+
+# Inclusive GL account code ranges for each account class; adjust to match the chart of accounts
+CHART_OF_ACCOUNTS = {
+    AccountClass.ASSET: [(1000, 1999)],
+    AccountClass.LIABILITY: [(2000, 2999)],
+    AccountClass.EQUITY: [(3000, 3999)],
+    AccountClass.REVENUE: [(4000, 4999)],
+    AccountClass.COST_OF_GOODS_SOLD: [(5000, 5999)],
+    AccountClass.OPERATING_EXPENSES: [(6000, 9999)]
+}
+
+INCOME_STATEMENT_ACCOUNT_CLASSES = [
+    AccountClass.REVENUE,
+    AccountClass.COST_OF_GOODS_SOLD,
+    AccountClass.OPERATING_EXPENSES
+]
+
+BALANCE_SHEET_ACCOUNT_CLASSES = [
+    AccountClass.ASSET,
+    AccountClass.LIABILITY,
+    AccountClass.EQUITY
+]
+
+
+# Inclusive GL account code ranges of cash and of retained earnings, whose movements are not cash flows:
+# the cash flow statement explains the movement in cash and starts from net profit
+CASH_ACCOUNTS = [(1000, 1019)]
+RETAINED_EARNINGS_ACCOUNTS = [(3020, 3029)]
+
+# Inclusive GL account code ranges of balance sheet accounts whose movements are investing or financing activities.
+# Every other balance sheet account (besides cash and retained earnings) is an operating activity.
+CASH_FLOW_ACTIVITIES = {
+    CashFlowActivity.INVESTING: [(1040, 1049)],
+    CashFlowActivity.FINANCING: [(2030, 2999), (3000, 3019), (3030, 3999)]
+}
+
+# Entity assigned to trial balances without an entity column, and the label of the consolidated group
+DEFAULT_ENTITY = "Company"
+CONSOLIDATED_ENTITY = "Consolidated"
+
+# Inclusive GL account code ranges of intercompany accounts (receivables, payables, sales and purchases between
+# entities), eliminated whenever more than one entity is consolidated
+INTERCOMPANY_ACCOUNTS = [(1060, 1069), (2040, 2049), (4090, 4099), (5090, 5099)]
+
+# Statement layouts: sections in display order. A section lists the accounts in one class of class_column
+# (with an optional sign applied to their values) followed by its subtotal, or is a subtotal alone
+# calculated from earlier subtotals via a formula of {subtotal: coefficient}.
+INCOME_STATEMENT_LAYOUT = {
+    "class_column": "account_class",
+    "values": "activity",
+    "sections": [
+        {
+            "class": AccountClass.REVENUE,
+            "sign": -1,
+            "subtotal": IncomeStatementCategory.TOTAL_REVENUE
+        },
+        {
+            "class": AccountClass.COST_OF_GOODS_SOLD,
+            "subtotal": IncomeStatementCategory.TOTAL_COST_OF_GOODS_SOLD
+        },
+        {
+            "subtotal": IncomeStatementCategory.GROSS_PROFIT,
+            "formula": {
+                IncomeStatementCategory.TOTAL_REVENUE: 1,
+                IncomeStatementCategory.TOTAL_COST_OF_GOODS_SOLD: -1
+            }
+        },
+        {
+            "class": AccountClass.OPERATING_EXPENSES,
+            "subtotal": IncomeStatementCategory.TOTAL_OPERATING_EXPENSES
+        },
+        {
+            "subtotal": IncomeStatementCategory.NET_PROFIT,
+            "formula": {
+                IncomeStatementCategory.GROSS_PROFIT: 1,
+                IncomeStatementCategory.TOTAL_OPERATING_EXPENSES: -1
+            }
+        }
+    ]
+}
+
+BALANCE_SHEET_LAYOUT = {
+    "class_column": "account_class",
+    "values": "closing_balance",
+    "sections": [
+        {
+            "class": AccountClass.ASSET,
+            "subtotal": BalanceSheetCategory.TOTAL_ASSETS
+        },
+        {
+            "class": AccountClass.LIABILITY,
+            "subtotal": BalanceSheetCategory.TOTAL_LIABILITIES
+        },
+        {
+            "class": AccountClass.EQUITY,
+            "subtotal": BalanceSheetCategory.TOTAL_EQUITY
+        }
+    ]
+}
+
+# Indirect method: net profit plus the cash effect of balance sheet movements (see CASH_FLOW_ACTIVITIES)
+CASH_FLOW_STATEMENT_LAYOUT = {
+    "class_column": "cash_flow_activity",
+    "values": "cash_flow",
+    "sections": [
+        {
+            "class": CashFlowActivity.OPERATING,
+            "subtotal": CashFlowCategory.NET_CASH_FROM_OPERATING_ACTIVITIES
+        },
+        {
+            "class": CashFlowActivity.INVESTING,
+            "subtotal": CashFlowCategory.NET_CASH_FROM_INVESTING_ACTIVITIES
+        },
+        {
+            "class": CashFlowActivity.FINANCING,
+            "subtotal": CashFlowCategory.NET_CASH_FROM_FINANCING_ACTIVITIES
+        },
+        {
+            "subtotal": CashFlowCategory.NET_CHANGE_IN_CASH,
+            "formula": {
+                CashFlowCategory.NET_CASH_FROM_OPERATING_ACTIVITIES: 1,
+                CashFlowCategory.NET_CASH_FROM_INVESTING_ACTIVITIES: 1,
+                CashFlowCategory.NET_CASH_FROM_FINANCING_ACTIVITIES: 1
+            }
+        }
+    ]
+}
+
+STATEMENT_LAYOUTS = {
+    Statement.INCOME_STATEMENT: INCOME_STATEMENT_LAYOUT,
+    Statement.BALANCE_SHEET: BALANCE_SHEET_LAYOUT,
+    Statement.CASH_FLOW_STATEMENT: CASH_FLOW_STATEMENT_LAYOUT
+}
+
+# Largest difference between amounts that validation still treats as equal (rounding to the cent)
+VALIDATION_TOLERANCE = 0.005
+VALIDATION_DISPLAY_MAX_ROWS = 1000
+
+# An account's activity is unusual when it is more than ANOMALY_Z_SCORE standard deviations from its mean over the
+# preceding ANOMALY_WINDOW_MONTHS (with at least ANOMALY_MIN_HISTORY_MONTHS of them), and a spike when it changes by more
+# than ANOMALY_SPIKE_RATIO of the prior month's. Movements of less than ANOMALY_MIN_AMOUNT are never flagged.
+ANOMALY_WINDOW_MONTHS = 12
+ANOMALY_MIN_HISTORY_MONTHS = 6
+ANOMALY_Z_SCORE = 3.0
+ANOMALY_SPIKE_RATIO = 1.0
+ANOMALY_MIN_AMOUNT = 1000.0
+ANOMALY_DISPLAY_MAX_ROWS = 100
+
+# Statements whose rows can be drilled into: their sections are account classes, which the account index carries
+DRILL_DOWN_STATEMENTS = [Statement.INCOME_STATEMENT, Statement.BALANCE_SHEET]
+
+
+# Data locations can be overridden through the environment, e.g. to point the benchmarks at a synthetic ledger.
+# The trial balance is a CSV file, a directory of CSV and Parquet files or a database URL (see connectors.py)
+TRIAL_BALANCE_PATH = os.environ.get("TRIAL_BALANCE_PATH", "data/trial_balance.csv")
+TRIAL_BALANCE_STORE_PATH = os.environ.get("TRIAL_BALANCE_STORE_PATH", "data/store/trial_balance")
+
+# Budget and forecast sources have the trial balance's schema; a scenario whose source is missing is not offered
+BUDGET_PATH = os.environ.get("BUDGET_PATH", "data/budget.csv")
+BUDGET_STORE_PATH = os.environ.get("BUDGET_STORE_PATH", "data/store/budget")
+FORECAST_PATH = os.environ.get("FORECAST_PATH", "data/forecast.csv")
+FORECAST_STORE_PATH = os.environ.get("FORECAST_STORE_PATH", "data/store/forecast")
+
+SCENARIO_LOCATIONS = {
+    Scenario.ACTUAL: {"source": TRIAL_BALANCE_PATH, "store": TRIAL_BALANCE_STORE_PATH},
+    Scenario.BUDGET: {"source": BUDGET_PATH, "store": BUDGET_STORE_PATH},
+    Scenario.FORECAST: {"source": FORECAST_PATH, "store": FORECAST_STORE_PATH}
+}
+
+# Table read from database sources that don't name one, connections kept open per database source, and rows
+# fetched per batch from SQLite sources
+TRIAL_BALANCE_TABLE = os.environ.get("TRIAL_BALANCE_TABLE", "trial_balance")
+CONNECTION_POOL_SIZE = 4
+DATABASE_BATCH_ROWS = 100_000
+
+# Seconds between checks of the trial balance for changes by the background refresher
+REFRESH_INTERVAL_SECONDS = float(os.environ.get("REFRESH_INTERVAL_SECONDS", 30))
+
+# Memory held by statements and chart specs derived from the trial balance, shared by every session
+SHARED_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+STORE_FILE_CACHE_MAX_ENTRIES = 128
+
+# Stage timings of every page run are appended here as JSON lines (set to an empty string to disable)
+INSTRUMENTATION_LOG_PATH = os.environ.get("INSTRUMENTATION_LOG_PATH", "logs/instrumentation.jsonl")
+# The log is rotated at this size, keeping this many previous files (instrumentation.jsonl.1 being the latest)
+INSTRUMENTATION_LOG_MAX_BYTES = 10 * 1024 * 1024
+INSTRUMENTATION_LOG_BACKUPS = 5
+
+# Password that logs in with admin access, e.g. to the run timings panel (unset disables admin access)
+ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD")
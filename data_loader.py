@@ -0,0 +1,721 @@
+"""
+Data loading functions.
+
+The trial balance is ingested from its source (see connectors.py) once into a columnar store of uncompressed Arrow IPC files,
+one per entity and period and sorted by GL account code. When the source holds several entities,
+a consolidated file per period (intercompany accounts eliminated) is written alongside, so the
+consolidated group reads as little data as a single entity. Pages scan only the files they need;
+the files are memory-mapped so unchanged data is never parsed or copied again. Each entity (and the
+consolidation) also gets its full history sorted by account, with an index of each account's rows,
+for drilling into single accounts. Every ingest validates the trial balance and scans it for unusual
+account activity, storing the failures and anomalies with the snapshot, so pages can flag them
+without computing them themselves.
+
+Readers use an immutable snapshot of the store (its manifest), swapped atomically once a new
+trial balance has been ingested off the request path by the background refresher. Files are
+named by their content and never overwritten, so a snapshot stays readable while the next builds.
+A page run pins the snapshot it started with, so every read in the run sees the same data, and the
+files of pinned snapshots are kept until their last reader has finished. The snapshot is shared by
+all sessions, as are the results derived from it (through the process-wide shared cache).
+
+Author: Yakir Havin
+"""
+
+
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime
+from enum import Enum
+from functools import lru_cache
+from typing import Callable
+from urllib.parse import quote
+
+import polars as pl
+import polars.selectors as cs
+
+import anomalies
+import connectors
+import instrumentation
+import shared_cache
+import validation
+from connectors import TRIAL_BALANCE_SCHEMA
+from constants import (
+    AccountClass,
+    Scenario,
+    CHART_OF_ACCOUNTS,
+    CONSOLIDATED_ENTITY,
+    INTERCOMPANY_ACCOUNTS,
+    STORE_FILE_CACHE_MAX_ENTRIES,
+    REFRESH_INTERVAL_SECONDS,
+    SCENARIO_LOCATIONS,
+    TRIAL_BALANCE_PATH,
+    TRIAL_BALANCE_STORE_PATH
+)
+
+
+ACCOUNT_CLASS_DTYPE = pl.Enum([account_class.value for account_class in AccountClass])
+
+MANIFEST_FILE = "manifest.json"
+CONSOLIDATED_DIRECTORY = "_consolidated"
+STORE_FORMAT_VERSION = 8  # Bump when the stored columns change so existing stores are rebuilt
+
+# Current snapshot of each store, replaced (never mutated) when a refresh completes: {store: manifest}
+_snapshots: dict[str, dict] = {}
+_refreshers: dict[str, threading.Thread] = {}
+_refreshers_lock = threading.Lock()  # Only guards the registry, so starting a refresher never waits on an ingest
+# One ingest lock per store, so stores (e.g. actuals and budget) ingest independently: {store: lock}
+_ingest_locks: dict[str, threading.Lock] = {}
+_ingest_locks_lock = threading.Lock()
+
+# Snapshots in use by page runs, counted by reader: {(store, version): [readers, manifest]}
+_pinned: dict[tuple[str, str], list] = {}
+_pinned_lock = threading.Lock()
+_local = threading.local()  # The snapshots pinned by the current thread's run: {store: manifest}
+
+
+def code_range_expression(code_ranges_by_value: dict[Enum, list[tuple[int, int]]]) -> pl.Expr:
+    """Map GL account codes to enum values using inclusive code ranges (unmatched codes are null)."""
+    code = pl.col("gl_account_code").cast(pl.Utf8).cast(pl.Int64, strict=False)
+    expression = pl
+    for value, code_ranges in code_ranges_by_value.items():
+        for low, high in code_ranges:
+            expression = expression.when(code.is_between(low, high)).then(pl.lit(value.value))
+    return expression.otherwise(None)
+
+
+def account_class_expression(chart_of_accounts: dict[AccountClass, list[tuple[int, int]]]=CHART_OF_ACCOUNTS) -> pl.Expr:
+    """Map GL account codes to account classes using inclusive code ranges (unmatched codes are null)."""
+    return code_range_expression(chart_of_accounts).cast(ACCOUNT_CLASS_DTYPE).alias("account_class")
+
+
+def intercompany_accounts(code_ranges: list[tuple[int, int]]=INTERCOMPANY_ACCOUNTS) -> pl.LazyFrame:
+    """Expand the intercompany code ranges into elimination rules, one row per GL account code."""
+    return pl.LazyFrame(
+        {"code": [code for low, high in code_ranges for code in range(low, high + 1)]},
+        schema={"code": pl.Int64}
+    ).with_columns(pl.lit(True).alias("intercompany"))
+
+
+def read_trial_balance(source: str=TRIAL_BALANCE_PATH) -> pl.DataFrame:
+    """Read a trial balance from its source, classify its accounts and sort it, without caching."""
+    return classify_trial_balance(connectors.connect(source).scan())
+
+
+def classify_trial_balance(lf: pl.LazyFrame) -> pl.DataFrame:
+    """
+    Classify the accounts of a conformed trial balance (see connectors.conform) and sort it.
+    Intercompany accounts are flagged by joining the rows to the elimination rules.
+    """
+    return lf.with_columns(
+        pl.col("gl_account_code").cast(pl.Int64, strict=False).alias("code")
+    ).join(intercompany_accounts(), on="code", how="left").select(
+        pl.col("entity").cast(pl.Categorical),
+        pl.exclude("entity", "code", "intercompany"),
+        account_class_expression(),
+        pl.col("intercompany").fill_null(False)
+    ).sort("entity", "period", "gl_account_code").with_columns(
+        pl.col("gl_account_code").cast(pl.Categorical)
+    ).collect()
+
+
+def store_configuration() -> str:
+    """Identify the store layout, chart of accounts and elimination rules that partitions are built with."""
+    chart_of_accounts = sorted((account_class.value, code_ranges) for account_class, code_ranges in CHART_OF_ACCOUNTS.items())
+    return hashlib.md5(repr((STORE_FORMAT_VERSION, chart_of_accounts, INTERCOMPANY_ACCOUNTS)).encode()).hexdigest()[:8]
+
+
+def store_version(source: str, since: date | None=None) -> str:
+    """
+    Identify the store that would be built from a source with the current configuration. Incremental sources are
+    identified from a period on, the high-water mark of the snapshot they are compared with.
+    """
+    return f"{connectors.connect(source).version(since)}-{store_configuration()}"
+
+
+def high_water_mark(manifest: dict | None) -> date | None:
+    """Return the period an incremental source was pulled up to for a snapshot (None for other sources)."""
+    if manifest is None or manifest.get("high_water_mark") is None:
+        return None
+    return date.fromisoformat(manifest["high_water_mark"])
+
+
+def read_manifest(store: str=TRIAL_BALANCE_STORE_PATH) -> dict | None:
+    """Return the store manifest, or None if the store has not been built."""
+    try:
+        with open(os.path.join(store, MANIFEST_FILE)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def content_file_name(name: str, fingerprint: str, configuration: str) -> str:
+    """Name a store file by its content, so changed data always gets a new file and existing files are never overwritten."""
+    return f"{name}-{hashlib.md5(f'{configuration}-{fingerprint}'.encode()).hexdigest()[:12]}.arrow"
+
+
+def partition_fingerprints(df: pl.DataFrame) -> dict[str, dict[str, str]]:
+    """Hash each entity's rows in each period so unchanged partitions can be skipped when the source is re-ingested."""
+    fingerprints = df.group_by("entity", "period").agg(
+        pl.struct(
+            pl.exclude("entity", "period", "gl_account_code", "account_class"),
+            pl.col("gl_account_code").cast(pl.Utf8)
+        ).hash(seed=0).sum()
+    )
+    partitions = {}
+    for entity, period, fingerprint in fingerprints.iter_rows():
+        partitions.setdefault(entity, {})[period.isoformat()] = str(fingerprint)
+    return partitions
+
+
+def consolidated_fingerprints(fingerprints: dict[str, dict[str, str]]) -> dict[str, str]:
+    """Combine the entity fingerprints of each period, so a consolidated period changes when any entity's does."""
+    periods = {}
+    for entity, entity_fingerprints in sorted(fingerprints.items()):
+        for period, fingerprint in entity_fingerprints.items():
+            periods.setdefault(period, []).append((entity, fingerprint))
+    return {period: hashlib.md5(repr(entries).encode()).hexdigest() for period, entries in periods.items()}
+
+
+def consolidate(df: pl.DataFrame | pl.LazyFrame) -> pl.LazyFrame:
+    """Total a multi-entity trial balance to one row per period and account, eliminating intercompany accounts."""
+    lf = df.lazy()
+    return lf.filter(~pl.col("intercompany")).group_by(
+        "period", "gl_account_code", "gl_account_description", "account_class"
+    ).agg(
+        cs.numeric().sum()
+    ).with_columns(
+        pl.lit(CONSOLIDATED_ENTITY).cast(pl.Categorical).alias("entity"),
+        pl.lit(False).alias("intercompany")
+    ).select(lf.collect_schema().names()).sort("period", pl.col("gl_account_code").cast(pl.Utf8))
+
+
+def calculate_rollup(df: pl.DataFrame | pl.LazyFrame) -> pl.LazyFrame:
+    """Total a trial balance to one row per entity, period, account class and intercompany flag."""
+    return df.lazy().group_by(pl.col("entity").cast(pl.Utf8), "period", "account_class", "intercompany").agg(
+        pl.col("debit").sum(),
+        pl.col("credit").sum(),
+        pl.col("activity").sum(),
+        pl.col("closing_balance").sum()
+    )
+
+
+def write_accounts(store: str, directory: str, periods: dict[str, dict], previous_entry: dict | None, configuration: str) -> dict:
+    """
+    Write the history of one entity (or the consolidation) sorted by account and period, from its period files, with an
+    index of the offset and number of rows of each account. Returns its manifest entry, reusing the previous one if no
+    period changed.
+    """
+    fingerprint = hashlib.md5(repr(sorted((period, entry["fingerprint"]) for period, entry in periods.items())).encode()).hexdigest()
+    if previous_entry is not None and previous_entry.get("fingerprint") == fingerprint:
+        return previous_entry
+
+    # A stable sort of the period-ordered rows by code keeps an account class's accounts (a code range) contiguous
+    accounts_df = pl.scan_ipc([os.path.join(store, entry["file"]) for _, entry in sorted(periods.items())]).sort(
+        pl.col("gl_account_code").cast(pl.Utf8), maintain_order=True
+    ).collect()
+    index_df = accounts_df.with_row_index("offset").group_by(pl.col("gl_account_code").cast(pl.Utf8), maintain_order=True).agg(
+        pl.col("gl_account_description").last(),
+        pl.col("account_class").first(),
+        pl.col("offset").first(),
+        pl.len().alias("rows")
+    )
+
+    entry = {
+        "file": f"{directory}/{content_file_name('accounts', fingerprint, configuration)}",
+        "index": f"{directory}/{content_file_name('accounts-index', fingerprint, configuration)}",
+        "fingerprint": fingerprint
+    }
+    _write_atomic(os.path.join(store, entry["file"]), lambda path: accounts_df.write_ipc(path, compression="uncompressed"))
+    _write_atomic(os.path.join(store, entry["index"]), lambda path: index_df.write_ipc(path, compression="uncompressed"))
+    return entry
+
+
+def ingest_trial_balance(source: str=TRIAL_BALANCE_PATH, store: str=TRIAL_BALANCE_STORE_PATH) -> dict:
+    """
+    Convert a trial balance into the entity and period partitioned IPC store and return its manifest.
+    Incremental sources are pulled from the previous snapshot's high-water mark on, keeping the closed periods before it
+    from the store, when the previous snapshot was built from the same source and configuration.
+    Only partitions that are new or whose rows changed are written, in the entity, consolidated, account and rollup files.
+    The whole trial balance is validated and scanned for anomalies, and its failures and anomalies are written alongside.
+    The manifest is replaced last, so the previous manifest and its files stay valid until then.
+    """
+    connector = connectors.connect(source)
+    configuration = store_configuration()
+    superseded_manifest = read_manifest(store) or {}
+    # Taken before the pull, so data arriving during it triggers another (incremental) refresh rather than being missed
+    latest_period = connector.high_water_mark()
+    version = store_version(source, latest_period)
+    as_of = connector.modified_at()
+
+    pulled_from = None
+    if connector.incremental and superseded_manifest.get("source") == connector.location and superseded_manifest.get("configuration") == configuration:
+        pulled_from = high_water_mark(superseded_manifest)
+    if pulled_from is None:
+        df = read_trial_balance(source)
+    else:
+        closed_files = [
+            os.path.join(store, entry["file"]) for periods in superseded_manifest["entities"].values()
+            for period, entry in periods.items() if date.fromisoformat(period) < pulled_from
+        ]
+        closed = [pl.scan_ipc(closed_files).select(pl.col(column).cast(dtype) for column, dtype in TRIAL_BALANCE_SCHEMA.items())] if closed_files else []
+        df = classify_trial_balance(pl.concat([*closed, connector.scan(from_period=pulled_from)]))
+    os.makedirs(store, exist_ok=True)
+
+    with instrumentation.stage("validation") as record:
+        failures = validation.validate_trial_balance(df)
+        record["rows"] = failures.height
+    validation_file = content_file_name("validation", version, configuration)
+    _write_atomic(os.path.join(store, validation_file), lambda path: failures.write_ipc(path, compression="uncompressed"))
+
+    with instrumentation.stage("anomalies") as record:
+        account_anomalies = anomalies.detect_anomalies(df)
+        record["rows"] = account_anomalies.height
+    anomalies_file = content_file_name("anomalies", version, configuration)
+    _write_atomic(os.path.join(store, anomalies_file), lambda path: account_anomalies.write_ipc(path, compression="uncompressed"))
+
+    if superseded_manifest.get("configuration") == configuration:
+        previous_manifest = superseded_manifest
+    else:
+        previous_manifest = {"entities": {}, "consolidated": {}, "accounts": {}, "consolidated_accounts": None}  # Partitions built with another configuration can't be reused
+
+    fingerprints = partition_fingerprints(df)
+    writes = {}
+    changed_partitions = []
+
+    entities = {}
+    for (entity, period), partition_df in df.group_by("entity", "period", maintain_order=True):
+        fingerprint = fingerprints[entity][period.isoformat()]
+        file_name = f"{quote(entity, safe='')}/{content_file_name(f'{period:%Y-%m}', fingerprint, configuration)}"
+        if previous_manifest["entities"].get(entity, {}).get(period.isoformat(), {}).get("fingerprint") != fingerprint:
+            writes[file_name] = partition_df
+            changed_partitions.append((entity, period))
+        entities.setdefault(entity, {})[period.isoformat()] = {"file": file_name, "rows": partition_df.height, "fingerprint": fingerprint}
+
+    # A single entity is its own consolidation, so consolidated files are only written for several entities
+    consolidated = {}
+    if len(entities) > 1:
+        fingerprints_by_period = consolidated_fingerprints(fingerprints)
+        consolidated = {
+            period: previous_manifest["consolidated"][period] for period, fingerprint in fingerprints_by_period.items()
+            if previous_manifest["consolidated"].get(period, {}).get("fingerprint") == fingerprint
+        }
+        changed_periods = [date.fromisoformat(period) for period in fingerprints_by_period if period not in consolidated]
+        consolidated_df = consolidate(df.filter(pl.col("period").is_in(changed_periods))).collect()
+        for (period,), partition_df in consolidated_df.group_by("period", maintain_order=True):
+            file_name = f"{CONSOLIDATED_DIRECTORY}/{content_file_name(f'{period:%Y-%m}', fingerprints_by_period[period.isoformat()], configuration)}"
+            writes[file_name] = partition_df
+            consolidated[period.isoformat()] = {"file": file_name, "rows": partition_df.height, "fingerprint": fingerprints_by_period[period.isoformat()]}
+
+    # Partitions are independent, so they are written in parallel (polars releases the GIL while writing)
+    for directory in {os.path.dirname(file_name) for file_name in writes}:
+        os.makedirs(os.path.join(store, directory), exist_ok=True)
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(
+            lambda file_name: _write_atomic(os.path.join(store, file_name), lambda path: writes[file_name].write_ipc(path, compression="uncompressed")),
+            writes
+        ))
+
+        # Account files are rebuilt from the period files of entities (and the consolidation) with changed periods
+        consolidated_accounts = None
+        if consolidated:
+            consolidated_accounts = executor.submit(
+                write_accounts, store, CONSOLIDATED_DIRECTORY, consolidated, previous_manifest["consolidated_accounts"], configuration
+            )
+        accounts = dict(zip(entities, executor.map(
+            lambda entity: write_accounts(store, quote(entity, safe=""), entities[entity], previous_manifest["accounts"].get(entity), configuration),
+            entities
+        )))
+        if consolidated_accounts is not None:
+            consolidated_accounts = consolidated_accounts.result()
+
+    # Recompute rollup rows for changed partitions only, keeping the rest from the previous rollup
+    rollup_file = content_file_name("rollup", version, configuration)
+    if previous_manifest["entities"]:
+        partition_schema = {"entity": pl.Utf8, "period": pl.Date}
+        current = pl.DataFrame(
+            [(entity, date.fromisoformat(period)) for entity, periods in entities.items() for period in periods],
+            schema=partition_schema,
+            orient="row"
+        )
+        changed = pl.DataFrame(changed_partitions, schema=partition_schema, orient="row")
+        rollup = pl.concat([
+            pl.read_ipc(os.path.join(store, previous_manifest["rollup"])).join(current, on=["entity", "period"], how="semi").join(changed, on=["entity", "period"], how="anti"),
+            calculate_rollup(pl.concat([writes[entities[entity][period.isoformat()]["file"]] for entity, period in changed_partitions] or [df.clear()])).collect()
+        ])
+    else:
+        rollup = calculate_rollup(df).collect()
+    rollup = rollup.sort("entity", "period", "account_class", "intercompany")
+    _write_atomic(os.path.join(store, rollup_file), lambda path: rollup.write_ipc(path, compression="uncompressed"))
+
+    manifest = {
+        "source": connector.location,
+        "version": version,
+        "high_water_mark": latest_period.isoformat() if connector.incremental and latest_period is not None else None,
+        "as_of": as_of.isoformat(),
+        "configuration": configuration,
+        "entities": entities,
+        "consolidated": consolidated,
+        "accounts": accounts,
+        "consolidated_accounts": consolidated_accounts,
+        "rollup": rollup_file,
+        "validation": validation_file,
+        "anomalies": anomalies_file
+    }
+    _write_atomic(os.path.join(store, MANIFEST_FILE), lambda path: _write_json(path, manifest))
+
+    # Remove files referenced by neither this manifest nor the one it replaces, which readers may still be scanning
+    # or a page run has pinned
+    retained_files = manifest_files(manifest) | manifest_files(superseded_manifest)
+    for pinned_manifest in pinned_snapshots(store):
+        retained_files |= manifest_files(pinned_manifest)
+    for directory, _, file_names in os.walk(store):
+        for file_name in file_names:
+            relative_path = os.path.relpath(os.path.join(directory, file_name), store).replace(os.sep, "/")
+            if file_name.endswith(".arrow") and relative_path not in retained_files:
+                os.remove(os.path.join(directory, file_name))
+    return manifest
+
+
+def manifest_files(manifest: dict) -> set[str]:
+    """Return the paths, relative to the store, of every file a manifest references."""
+    partitions = [*manifest.get("entities", {}).values(), manifest.get("consolidated", {})]
+    accounts = [*manifest.get("accounts", {}).values(), *([manifest["consolidated_accounts"]] if manifest.get("consolidated_accounts") else [])]
+    return (
+        {entry["file"] for periods in partitions for entry in periods.values()} |
+        {file for entry in accounts for file in (entry["file"], entry["index"])} |
+        {manifest[file] for file in ["rollup", "validation", "anomalies"] if file in manifest}
+    )
+
+
+def ingest_lock(store: str) -> threading.Lock:
+    """Return the lock serializing ingests of a store."""
+    with _ingest_locks_lock:
+        return _ingest_locks.setdefault(os.path.abspath(store), threading.Lock())
+
+
+def current_snapshot(source: str=TRIAL_BALANCE_PATH, store: str=TRIAL_BALANCE_STORE_PATH) -> dict:
+    """
+    Return the snapshot (manifest) readers should use: the one pinned by the current thread's run, if any, or else the
+    current one. It is never mutated, so a reader can keep using it while a refresh swaps in the next one.
+    The store is only built on the request path when none has been built yet.
+    """
+    snapshot = getattr(_local, "pinned", {}).get(store) or _snapshots.get(store)
+    if snapshot is not None:
+        return snapshot
+
+    with ingest_lock(store):
+        if store not in _snapshots:
+            manifest = read_manifest(store)
+            if manifest is None or manifest.get("configuration") != store_configuration():
+                with instrumentation.stage("ingest") as record:
+                    manifest = ingest_trial_balance(source, store)
+                    record["rows"] = sum(entry["rows"] for periods in manifest["entities"].values() for entry in periods.values())
+            _snapshots[store] = manifest
+    return _snapshots[store]
+
+
+@contextmanager
+def pin_snapshot(source: str=TRIAL_BALANCE_PATH, store: str=TRIAL_BALANCE_STORE_PATH):
+    """
+    Pin the current snapshot for the current thread until the block exits, so a refresh completing mid-run neither
+    changes the data the run reads nor removes its files. Derived results of a snapshot nobody uses any more are
+    dropped from the shared cache once its last reader has finished.
+    """
+    pinned = _local.__dict__.setdefault("pinned", {})
+    if store in pinned:  # Already pinned further up the stack (e.g. a fragment inside a fragment)
+        yield pinned[store]
+        return
+
+    manifest = current_snapshot(source, store)
+    key = (os.path.abspath(store), manifest["version"])
+    with _pinned_lock:
+        _pinned.setdefault(key, [0, manifest])[0] += 1
+    pinned[store] = manifest
+    try:
+        yield manifest
+    finally:
+        del pinned[store]
+        with _pinned_lock:
+            _pinned[key][0] -= 1
+            if _pinned[key][0] == 0:
+                del _pinned[key]
+        shared_cache.retain_versions(live_versions())
+
+
+def pinned_snapshots(store: str=TRIAL_BALANCE_STORE_PATH) -> list[dict]:
+    """Return the snapshots of a store that page runs have pinned."""
+    with _pinned_lock:
+        return [manifest for (pinned_store, _), (_, manifest) in _pinned.items() if pinned_store == os.path.abspath(store)]
+
+
+def snapshot_readers() -> dict[str, int]:
+    """Return the number of page runs reading each pinned snapshot version."""
+    with _pinned_lock:
+        return {version: readers for (_, version), (readers, _) in _pinned.items()}
+
+
+def live_versions() -> set[str]:
+    """Return the versions of every current or pinned snapshot, whose derived results are worth keeping."""
+    with _pinned_lock:
+        return {snapshot["version"] for snapshot in list(_snapshots.values())} | {version for _, version in _pinned}
+
+
+def refresh(source: str=TRIAL_BALANCE_PATH, store: str=TRIAL_BALANCE_STORE_PATH) -> bool:
+    """Ingest the source if it has changed since the current snapshot and swap in the new snapshot. Returns whether it did."""
+    with ingest_lock(store):
+        snapshot = _snapshots.get(store) or read_manifest(store)
+        if snapshot is not None and snapshot["version"] == store_version(source, high_water_mark(snapshot)):
+            _snapshots[store] = snapshot
+            return False
+        _snapshots[store] = ingest_trial_balance(source, store)
+    shared_cache.retain_versions(live_versions())
+    return True
+
+
+def start_refresher(source: str=TRIAL_BALANCE_PATH, store: str=TRIAL_BALANCE_STORE_PATH, interval: float=REFRESH_INTERVAL_SECONDS):
+    """Start the background thread that refreshes a store from its source (once per process and store)."""
+    with _refreshers_lock:
+        if store in _refreshers and _refreshers[store].is_alive():
+            return
+        _refreshers[store] = threading.Thread(
+            target=_refresh_loop,
+            args=(source, store, interval),
+            name=f"refresher-{os.path.basename(store)}",
+            daemon=True
+        )
+        _refreshers[store].start()
+
+
+def _refresh_loop(source: str, store: str, interval: float):
+    """
+    Poll the source and refresh once it has changed and then held still for a whole interval, so a file that is still
+    being uploaded is not ingested. Failures keep the current snapshot and are retried at the next change.
+    """
+    pending_version = None
+    failed_version = None
+    while True:
+        try:
+            snapshot = _snapshots.get(store) or read_manifest(store)
+            version = store_version(source, high_water_mark(snapshot))
+            if snapshot is None or snapshot["version"] != version:
+                if version == pending_version and version != failed_version:
+                    failed_version = version  # Cleared once the refresh succeeds
+                    refresh(source, store)
+                    failed_version = None
+                pending_version = version
+        except Exception:
+            traceback.print_exc()
+        time.sleep(interval)
+
+
+def data_version(source: str=TRIAL_BALANCE_PATH, store: str=TRIAL_BALANCE_STORE_PATH) -> str:
+    """Return the version of the current snapshot, for keying caches of derived results."""
+    return current_snapshot(source, store)["version"]
+
+
+def data_as_of(source: str=TRIAL_BALANCE_PATH, store: str=TRIAL_BALANCE_STORE_PATH) -> datetime:
+    """Return when the trial balance behind the current snapshot was last modified (timezone-aware, UTC)."""
+    return datetime.fromisoformat(current_snapshot(source, store)["as_of"])
+
+
+def fetch_periods(source: str=TRIAL_BALANCE_PATH, store: str=TRIAL_BALANCE_STORE_PATH) -> list[date]:
+    """List the periods available in the store without reading any ledger data."""
+    periods = {period for entity_periods in current_snapshot(source, store)["entities"].values() for period in entity_periods}
+    return [date.fromisoformat(period) for period in sorted(periods)]
+
+
+def fetch_entities(source: str=TRIAL_BALANCE_PATH, store: str=TRIAL_BALANCE_STORE_PATH) -> list[str]:
+    """List the entities available in the store without reading any ledger data."""
+    return sorted(current_snapshot(source, store)["entities"])
+
+
+def resolve_entities(manifest: dict, entities: list[str] | tuple[str, ...] | None) -> list[str]:
+    """Return the entities to consolidate, all of them when none are given."""
+    if not entities:
+        return sorted(manifest["entities"])
+    unknown = set(entities) - set(manifest["entities"])
+    if unknown:
+        raise ValueError(f"Unknown entities: {', '.join(sorted(unknown))}")
+    return sorted(set(entities))
+
+
+def scan_trial_balance(from_period: date | None=None, to_period: date | None=None, entities: list[str] | tuple[str, ...] | None=None,
+                       source: str=TRIAL_BALANCE_PATH, store: str=TRIAL_BALANCE_STORE_PATH) -> pl.LazyFrame:
+    """
+    Lazily scan the memory-mapped files of some entities (all by default) that fall within a period range (inclusive).
+    All entities are read from the consolidated files; a subset of several entities is scanned in parallel with
+    intercompany accounts eliminated.
+    """
+    manifest = current_snapshot(source, store)
+    entities = resolve_entities(manifest, entities)
+    if manifest["consolidated"] and len(entities) == len(manifest["entities"]):
+        partitions = [manifest["consolidated"]]
+    else:
+        partitions = [manifest["entities"][entity] for entity in entities]
+
+    files = [
+        os.path.join(store, entry["file"])
+        for periods in partitions
+        for period, entry in sorted(periods.items())
+        if (from_period is None or period >= from_period.isoformat()) and
+           (to_period is None or period <= to_period.isoformat())
+    ]
+    if not files:
+        any_file = next(iter(next(iter(manifest["entities"].values())).values()))["file"]
+        return pl.LazyFrame(schema=pl.read_ipc_schema(os.path.join(store, any_file)))
+
+    lf = pl.scan_ipc(files)
+    if len(partitions) > 1:
+        lf = lf.filter(~pl.col("intercompany"))
+    return lf
+
+
+def scan_rollup(entities: list[str] | tuple[str, ...] | None=None,
+                source: str=TRIAL_BALANCE_PATH, store: str=TRIAL_BALANCE_STORE_PATH) -> pl.LazyFrame:
+    """
+    Lazily scan the rollup of some entities (all by default), which has the same total columns as the trial balance.
+    Intercompany accounts are eliminated when more than one entity is included.
+    """
+    manifest = current_snapshot(source, store)
+    entities = resolve_entities(manifest, entities)
+    lf = pl.scan_ipc(os.path.join(store, manifest["rollup"]))
+    if len(entities) < len(manifest["entities"]):
+        lf = lf.join(pl.LazyFrame({"entity": entities}), on="entity", how="semi")
+    if len(entities) > 1:
+        lf = lf.filter(~pl.col("intercompany"))
+    return lf
+
+
+def scenario_available(scenario: Scenario) -> bool:
+    """Return whether a scenario's source is there to be read (actuals always are)."""
+    return scenario == Scenario.ACTUAL or connectors.connect(SCENARIO_LOCATIONS[scenario]["source"]).exists()
+
+
+def scenario_versions(scenarios: list[Scenario]) -> tuple[str, ...]:
+    """Return the versions of some scenarios' current snapshots, for keying caches of results that compare them."""
+    return tuple(data_version(**SCENARIO_LOCATIONS[scenario]) for scenario in scenarios)
+
+
+def scan_scenario(scan: Callable[..., pl.LazyFrame], scenario: Scenario, entities: list[str] | tuple[str, ...] | None=None) -> pl.LazyFrame:
+    """
+    Scan a scenario's store with scan_trial_balance or scan_rollup (other arguments bound, e.g. with functools.partial),
+    labelling the rows with a scenario column so several scenarios can be aggregated together in one pass.
+    A budget or forecast without some of the entities has no rows for them, and none at all without any of them.
+    """
+    locations = SCENARIO_LOCATIONS[scenario]
+    if scenario != Scenario.ACTUAL and entities:
+        planned_entities = [entity for entity in entities if entity in current_snapshot(**locations)["entities"]]
+        lf = scan(planned_entities, **locations) if planned_entities else scan(None, **locations).clear()
+    else:
+        lf = scan(entities, **locations)
+    return lf.with_columns(pl.lit(scenario.value).alias("scenario"))
+
+
+def scan_scenarios(scan: Callable[..., pl.LazyFrame], scenarios: list[Scenario], entities: list[str] | tuple[str, ...] | None=None) -> pl.LazyFrame:
+    """Scan several scenarios' stores into one frame with scan_scenario."""
+    return pl.concat([scan_scenario(scan, scenario, entities) for scenario in scenarios])
+
+
+@lru_cache(maxsize=STORE_FILE_CACHE_MAX_ENTRIES)
+def read_store_file(path: str) -> pl.DataFrame:
+    """Read a small store file, such as an account index. Store files are named by content and never change, so they are cached by path."""
+    return pl.read_ipc(path)
+
+
+def account_entries(manifest: dict, entities: list[str]) -> list[dict]:
+    """Return the account files to read for some entities: the consolidated one when all entities are selected."""
+    if manifest["consolidated_accounts"] and len(entities) == len(manifest["entities"]):
+        return [manifest["consolidated_accounts"]]
+    return [manifest["accounts"][entity] for entity in entities]
+
+
+def fetch_account_index(entities: list[str] | tuple[str, ...] | None=None,
+                        source: str=TRIAL_BALANCE_PATH, store: str=TRIAL_BALANCE_STORE_PATH) -> pl.DataFrame:
+    """List the accounts of some entities (all by default) with their description and class, without reading ledger data."""
+    manifest = current_snapshot(source, store)
+    indexes = [read_store_file(os.path.join(store, entry["index"])) for entry in account_entries(manifest, resolve_entities(manifest, entities))]
+    return pl.concat(indexes).unique("gl_account_code", keep="first", maintain_order=True).sort("gl_account_code").select(
+        "gl_account_code", "gl_account_description", pl.col("account_class").cast(pl.Utf8)
+    )
+
+
+def fetch_account_history(gl_account_codes: list[str], entities: list[str] | tuple[str, ...] | None=None,
+                          source: str=TRIAL_BALANCE_PATH, store: str=TRIAL_BALANCE_STORE_PATH) -> pl.DataFrame:
+    """
+    Return every period of some accounts for some entities (all by default), consolidated and sorted by account and period.
+    Each account's rows are found in the account index and adjacent accounts are read as one slice of the memory-mapped
+    account file, so the cost follows the accounts' history rather than the size of the ledger. Intercompany accounts are
+    eliminated when more than one entity is included.
+    """
+    manifest = current_snapshot(source, store)
+    entities = resolve_entities(manifest, entities)
+    entries = account_entries(manifest, entities)
+
+    slices = []
+    for entry in entries:
+        lf = pl.scan_ipc(os.path.join(store, entry["file"]))
+        index = read_store_file(os.path.join(store, entry["index"]))
+        ranges = index.filter(pl.col("gl_account_code").is_in(list(gl_account_codes))).sort("offset").with_columns(
+            (pl.col("offset") != (pl.col("offset") + pl.col("rows")).shift(1)).fill_null(True).cum_sum().alias("range")
+        ).group_by("range", maintain_order=True).agg(
+            pl.col("offset").first(),
+            pl.col("rows").sum()
+        )
+        for offset, rows in ranges.select("offset", "rows").iter_rows():
+            slices.append(lf.slice(offset, rows))
+
+    columns = {
+        "gl_account_code": pl.Utf8,
+        "gl_account_description": pl.Utf8,
+        "period": pl.Date,
+        "debit": pl.Float64,
+        "credit": pl.Float64,
+        "activity": pl.Float64,
+        "closing_balance": pl.Float64
+    }
+    if not slices:
+        return pl.DataFrame(schema=columns)
+
+    lf = pl.concat(slices).with_columns(pl.col("gl_account_code", "gl_account_description").cast(pl.Utf8))
+    if len(entries) > 1:
+        lf = lf.filter(~pl.col("intercompany")).group_by("gl_account_code", "period").agg(
+            pl.col("gl_account_description").first(),
+            pl.col("debit", "credit", "activity", "closing_balance").sum()
+        )
+    return lf.select(list(columns)).sort("gl_account_code", "period").collect()
+
+
+def fetch_validation_failures(source: str=TRIAL_BALANCE_PATH, store: str=TRIAL_BALANCE_STORE_PATH) -> pl.DataFrame:
+    """Return the validation failures of the trial balance behind the current snapshot (empty when it passed every rule)."""
+    return read_store_file(os.path.join(store, current_snapshot(source, store)["validation"]))
+
+
+def fetch_anomalies(from_period: date | None=None, to_period: date | None=None, entities: list[str] | tuple[str, ...] | None=None,
+                    source: str=TRIAL_BALANCE_PATH, store: str=TRIAL_BALANCE_STORE_PATH) -> pl.DataFrame:
+    """Return the anomalies of some entities (all by default) in a period range (inclusive) behind the current snapshot."""
+    manifest = current_snapshot(source, store)
+    entities = resolve_entities(manifest, entities)
+    df = read_store_file(os.path.join(store, manifest["anomalies"]))
+    if from_period is not None:
+        df = df.filter(pl.col("period") >= from_period)
+    if to_period is not None:
+        df = df.filter(pl.col("period") <= to_period)
+    return df.filter(pl.col("entity").is_in(entities)) if len(entities) < len(manifest["entities"]) else df
+
+
+def _write_atomic(path: str, write):
+    """Write to a temporary file then rename it over the target so readers never see a partial file."""
+    temporary_path = f"{path}.tmp"
+    write(temporary_path)
+    os.replace(temporary_path, path)
+
+
+def _write_json(path: str, content: dict):
+    with open(path, "w") as file:
+        json.dump(content, file, indent=2)
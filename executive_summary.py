@@ -1,133 +1,161 @@
-from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
+from datetime import datetime
 
-import streamlit as st
 import polars as pl
+import streamlit as st
+from streamlit.delta_generator import DeltaGenerator
+
+import anomalies
+import data_loader
+import instrumentation
+import metrics
+import utils
+from constants import Comparison, Metric, MetricBasis, Scenario, ANOMALY_DISPLAY_MAX_ROWS, COMPARISON_SCENARIOS
 
 
 # =======================
 # Functions
 # =======================
-# @st.cache_data(show_spinner=False)
-def fetch_data():
-    return pl.read_csv(
-        "data/trial_balance.csv",
-        schema_overrides={
-            "period": pl.Date,
-            "gl_account_code": pl.Utf8,
-            "opening_balance": pl.Float64,
-            "debit": pl.Float64,
-            "credit": pl.Float64,
-            "closing_balance": pl.Float64,
-            "activity": pl.Float64
-        }
-    ).sort("period")
-
-
-def metrics_section(df: pl.DataFrame, period_selection: datetime):
-    selected_df = df.filter(
-        (pl.col("period") == period_selection) &
-        (pl.col("gl_account_code").str.contains("^[4-9]"))
-    )
-
-    prior_period = (period_selection.replace(day=1) - timedelta(days=1)).replace(day=1)
-    prior_df = df.filter(
-        (pl.col("period") == prior_period) &
-        (pl.col("gl_account_code").str.contains("^[4-9]"))
-    )
-
-    # Sum each category for selected period
-    selected_total_revenue = selected_df.filter(
-        pl.col("gl_account_code").str.starts_with("4")
-    ).select(pl.col("activity").sum()).item() * -1
-
-    selected_total_cost_of_goods_sold = selected_df.filter(
-        pl.col("gl_account_code").str.starts_with("5")
-    ).select(pl.col("activity").sum()).item()
+def percentage(ratio: float | None) -> float | None:
+    return None if ratio is None else ratio * 100
 
-    selected_total_operating_expenses = selected_df.filter(
-        pl.col("gl_account_code").str.contains("^[6-9]")
-    ).select(pl.col("activity").sum()).item()
 
-    # Sum each category for prior period
-    prior_total_revenue = prior_df.filter(
-        pl.col("gl_account_code").str.starts_with("4")
-    ).select(pl.col("activity").sum()).item() * -1
+def variance(metric_summary: dict, comparison_selection: Comparison) -> float | str | None:
+    # Variances from a plan show both the amount and its ratio to the plan
+    if comparison_selection not in COMPARISON_SCENARIOS or metric_summary["delta_ratio"] is None:
+        return metric_summary["delta"]
+    return f"{utils.format_compact(metric_summary['delta'])} ({metric_summary['delta_ratio']:+.1%})"
 
-    prior_total_cost_of_goods_sold = prior_df.filter(
-        pl.col("gl_account_code").str.starts_with("5")
-    ).select(pl.col("activity").sum()).item()
 
-    prior_total_operating_expenses = prior_df.filter(
-        pl.col("gl_account_code").str.contains("^[6-9]")
-    ).select(pl.col("activity").sum()).item()
-
-    # Create subtotals for selected period
-    selected_total_gross_profit = selected_total_revenue - selected_total_cost_of_goods_sold
-    selected_total_net_profit = selected_total_gross_profit - selected_total_operating_expenses
-
-    # Create subtotals for prior period
-    prior_total_gross_profit = prior_total_revenue - prior_total_cost_of_goods_sold
-    prior_total_net_profit = prior_total_gross_profit - prior_total_operating_expenses
-
-    # Calculate deltas
-    total_revenue_delta = selected_total_revenue - prior_total_revenue
-    total_gross_profit_delta = selected_total_gross_profit - prior_total_gross_profit
-    total_net_profit_delta = selected_total_net_profit - prior_total_net_profit
+def metrics_section(container: DeltaGenerator, period_selection: datetime, basis_selection: MetricBasis, comparison_selection: Comparison,
+                    entity_selection: tuple[str, ...] | None):
+    scenarios = [Scenario.ACTUAL] + ([COMPARISON_SCENARIOS[comparison_selection]] if comparison_selection in COMPARISON_SCENARIOS else [])
+    lf = data_loader.scan_scenarios(data_loader.scan_rollup, scenarios, entity_selection)
+    summary = metrics.summarize_period(lf, period_selection, basis_selection, comparison_selection)
 
     # Display primary metrics
-    metrics_container = center.container()
+    metrics_container = container.container()
     metric1, metric2, metric3 = metrics_container.columns(3)
     metric1.metric(
         label="Revenue", 
-        value=selected_total_revenue, 
-        delta=total_revenue_delta, 
+        value=summary[Metric.REVENUE]["value"], 
+        delta=variance(summary[Metric.REVENUE], comparison_selection), 
         format="compact",
         border=True
     )
     metric2.metric(
         label="Gross profit", 
-        value=selected_total_gross_profit, 
-        delta=total_gross_profit_delta,
+        value=summary[Metric.GROSS_PROFIT]["value"], 
+        delta=variance(summary[Metric.GROSS_PROFIT], comparison_selection),
         format="compact",
         border=True
     
     )
     metric3.metric(label="Net profit",
-        value=selected_total_net_profit,
-        delta=total_net_profit_delta,
+        value=summary[Metric.NET_PROFIT]["value"],
+        delta=variance(summary[Metric.NET_PROFIT], comparison_selection),
         format="compact",
         border=True
     )
 
-    # Calculate secondary metrics
-    selected_gross_profit_ratio = selected_total_gross_profit / selected_total_revenue
-    prior_gross_profit_ratio = prior_total_gross_profit / prior_total_revenue if prior_total_revenue > 0 else 0
-    gross_profit_ratio_delta = selected_gross_profit_ratio - prior_gross_profit_ratio
-
-    selected_operating_expense_ratio = selected_total_operating_expenses / selected_total_revenue
-    prior_operating_expense_ratio = prior_total_operating_expenses / prior_total_revenue if prior_total_revenue > 0 else 0
-    operating_expense_ratio_delta = selected_operating_expense_ratio - prior_operating_expense_ratio
-
     # Display secondary metrics
     metric4, metric5, metric6 = metrics_container.columns(3)
     metric4.metric(
         label="Gross profit ratio",
-        value=selected_gross_profit_ratio * 100, 
-        delta=gross_profit_ratio_delta * 100,
+        value=percentage(summary[Metric.GROSS_PROFIT_RATIO]["value"]), 
+        delta=percentage(summary[Metric.GROSS_PROFIT_RATIO]["delta"]),
         format="%.1f%%",
         border=True
     )
     metric5.metric(
         label="Operating expense ratio", 
-        value=selected_operating_expense_ratio * 100, 
-        delta=operating_expense_ratio_delta * 100, 
+        value=percentage(summary[Metric.OPERATING_EXPENSE_RATIO]["value"]), 
+        delta=percentage(summary[Metric.OPERATING_EXPENSE_RATIO]["delta"]), 
         delta_color="inverse", 
         format="%.1f%%",
         border=True
     )
 
 
+def anomalies_section(container: DeltaGenerator, period_selection: datetime, entity_selection: tuple[str, ...] | None):
+    with instrumentation.stage("anomalies") as record:
+        df = data_loader.fetch_anomalies(period_selection, period_selection, entity_selection)
+        record["rows"] = df.height
+
+    badges = container.container(horizontal=True)
+    if df.is_empty():
+        badges.badge("No unusual account activity", icon=":material/check_circle:", color="green")
+        return
+    for rule, _, accounts in anomalies.summarize_anomalies(df).iter_rows():
+        badges.badge(f"{rule}: {accounts:,} accounts", icon=":material/troubleshoot:", color="orange")
+
+    # Largest departures from what was expected first
+    expander = container.expander("Unusual account activity")
+    expander.dataframe(
+        df.sort((pl.col("activity") - pl.col("expected")).abs(), descending=True).head(ANOMALY_DISPLAY_MAX_ROWS).drop("period"),
+        column_config={
+            "rule": "Rule",
+            "entity": "Entity",
+            "gl_account_code": "Account",
+            "gl_account_description": "Description",
+            "activity": st.column_config.NumberColumn(label="Activity", format="accounting"),
+            "expected": st.column_config.NumberColumn(label="Expected", format="accounting"),
+            "score": st.column_config.NumberColumn(
+                label="Score",
+                help="Standard deviations from the account's mean, or change from the prior month as a ratio",
+                format="%.1f"
+            )
+        },
+        hide_index=True
+    )
+    if df.height > ANOMALY_DISPLAY_MAX_ROWS:
+        expander.caption(f"Showing the {ANOMALY_DISPLAY_MAX_ROWS:,} largest of {df.height:,} anomalies.")
+
+
+@st.fragment
+def metrics_fragment(period_selection: datetime, entity_selection: tuple[str, ...] | None):
+    with utils.page_run("executive_summary.metrics"):
+        left_center, center_center, right_center = st.columns(3)
+
+        basis_selection = left_center.selectbox(
+            label="Basis",
+            options=list(MetricBasis),
+            format_func=lambda x: x.value
+        )
+
+        comparison_selection = left_center.selectbox(
+            label="Compare with",
+            options=[
+                comparison for comparison in Comparison
+                if comparison not in COMPARISON_SCENARIOS or data_loader.scenario_available(COMPARISON_SCENARIOS[comparison])
+            ],
+            format_func=lambda x: x.value
+        )
+
+        metrics_section(st.container(), period_selection, basis_selection, comparison_selection, entity_selection)
+
+
+@st.fragment
+def executive_summary_fragment():
+    with utils.page_run("executive_summary"):
+        left_center, center_center, right_center = st.columns(3)
+
+        period_options = utils.session_cached("period_options", data_loader.fetch_periods)
+        period_selection = left_center.selectbox(
+            label="Period",
+            options=reversed(period_options),
+            index=0,
+            format_func=lambda x: datetime.strftime(x, "%B %Y")
+        )
+
+        entity_selection = utils.select_entities(center_center)
+
+        # The basis and comparison only change the metrics, which rerun on their own
+        metrics_fragment(period_selection, entity_selection)
+        anomalies_section(st.container(), period_selection, entity_selection)
+
+        utils.data_as_of_section(st.container())
+
+
 # =======================
 # User interface
 # =======================
@@ -135,20 +163,11 @@ st.set_page_config(
     page_title="Executive summary | Executive Portal",
     layout="wide"
 )
+
 left, center, right = st.columns([1, 3.5, 1])
 center.header(":material/health_metrics: Executive summary")
-left_center, center_center, right_center = center.columns(3)
-
-df = fetch_data()
-
-period_options = df["period"].unique().to_list()
-period_selection = left_center.selectbox(
-    label="Period",
-    options=reversed(period_options),
-    index=0,
-    format_func=lambda x: datetime.strftime(x, "%B %Y")
-)
 
-metrics_section(df, period_selection)
+with center:
+    executive_summary_fragment()
 
-center.badge(f"Latest data: {datetime.now(tz=ZoneInfo("America/New_York")):%B %e, %Y}", color="grey")
\ No newline at end of file
+utils.validation_section(center)
@@ -0,0 +1,97 @@
+"""
+Statement exports, written straight from Polars.
+
+Author: Yakir Havin
+"""
+
+
+import tempfile
+from datetime import date
+from typing import IO
+
+import polars as pl
+import xlsxwriter
+
+import statements
+from constants import ExportFormat, Statement, EXPORT_CHUNK_ROWS, EXPORT_SPOOL_MAX_BYTES
+
+
+ACCOUNTING_FORMAT = '_(* #,##0.00_);_(* (#,##0.00);_(* "-"??_);_(@_)'
+PERCENT_FORMAT = "0.0%"
+
+
+def column_label(column: str) -> str:
+    """Label a statement's value column: periods by month, anything else (e.g. variance columns) as named."""
+    try:
+        return date.fromisoformat(column).strftime("%b %Y")
+    except ValueError:
+        return column
+
+
+def write_csv(df: pl.DataFrame, file: IO[bytes]):
+    """Write a frame as CSV, EXPORT_CHUNK_ROWS rows at a time."""
+    for offset in range(0, max(df.height, 1), EXPORT_CHUNK_ROWS):
+        df.slice(offset, EXPORT_CHUNK_ROWS).write_csv(file, include_header=offset == 0)
+
+
+def write_parquet(df: pl.DataFrame, file: IO[bytes]):
+    """Write a frame as Parquet, in row groups of EXPORT_CHUNK_ROWS rows."""
+    df.write_parquet(file, row_group_size=EXPORT_CHUNK_ROWS)
+
+
+def write_excel(df: pl.DataFrame, statement: Statement, file: IO[bytes], highlight_color: str="#f5f5f5"):
+    """
+    Write a statement as an Excel sheet laid out like the page, with period (or variance) headers, accounting formats and
+    shaded subtotal rows. The workbook is in constant memory mode, so each row is flushed to disk once written.
+    """
+    value_columns = [column for column in df.columns if column not in ["gl_account_code", "gl_account_description", "is_subtotal"]]
+
+    workbook = xlsxwriter.Workbook(file, {"constant_memory": True})
+    worksheet = workbook.add_worksheet(statement.value)
+    header_format = workbook.add_format({"bold": True, "bottom": 1, "align": "center"})
+    # Text and number formats of plain and subtotal rows, the number formats per value column
+    row_formats = {
+        is_subtotal: (
+            workbook.add_format(fill),
+            [
+                workbook.add_format({"num_format": PERCENT_FORMAT if column == statements.VARIANCE_RATIO_COLUMN else ACCOUNTING_FORMAT, **fill})
+                for column in value_columns
+            ]
+        )
+        for is_subtotal, fill in [(False, {}), (True, {"bg_color": highlight_color})]
+    }
+
+    worksheet.set_column(0, 0, 10)
+    worksheet.set_column(1, 1, 40)
+    worksheet.set_column(2, 1 + len(value_columns), 16)
+    worksheet.freeze_panes(1, 2)
+    worksheet.write_row(0, 0, ["Account", "Description"] + [column_label(column) for column in value_columns], header_format)
+
+    row_number = 1
+    for chunk in df.select(["gl_account_code", "gl_account_description"] + value_columns + ["is_subtotal"]).iter_slices(EXPORT_CHUNK_ROWS):
+        for code, description, *values, is_subtotal in chunk.iter_rows():
+            text_format, number_formats = row_formats[is_subtotal]
+            worksheet.write_row(row_number, 0, [code, description], text_format)
+            for column_number, (value, number_format) in enumerate(zip(values, number_formats), start=2):
+                worksheet.write(row_number, column_number, value, number_format)
+            row_number += 1
+
+    workbook.close()
+
+
+def export_statement(df: pl.DataFrame, statement: Statement, export_format: ExportFormat) -> bytes:
+    """
+    Export a statement (as built by statements.build_statement) without converting it to pandas. The is_subtotal flag
+    only styles Excel rows, so CSV and Parquet files leave it out. It is written in chunks to a temporary file that
+    stays in memory up to EXPORT_SPOOL_MAX_BYTES and moves to disk beyond, so only the finished file is ever held as
+    bytes.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES) as file:
+        if export_format == ExportFormat.EXCEL:
+            write_excel(df, statement, file)
+        elif export_format == ExportFormat.CSV:
+            write_csv(df.drop("is_subtotal"), file)
+        else:
+            write_parquet(df.drop("is_subtotal"), file)
+        file.seek(0)
+        return file.read()
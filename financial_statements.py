@@ -1,174 +1,159 @@
 from datetime import datetime
-from zoneinfo import ZoneInfo
 
 import streamlit as st
 import polars as pl
+from streamlit.delta_generator import DeltaGenerator
 
+import anomalies
+import data_loader
+import exports
+import instrumentation
+import statements
 import utils
-from constants import IncomeStatementCategory, BalanceSheetCategory
+from constants import ExportFormat, Scenario, Statement, DRILL_DOWN_STATEMENTS, EXPORT_CONSTANTS
 
 
 # =======================
 # Functions
 # =======================
-# @st.cache_data(show_spinner=False)
-def fetch_data():
-    return pl.read_csv(
-        "data/trial_balance.csv",
-        schema_overrides={
-            "period": pl.Date,
-            "gl_account_code": pl.Utf8,
-            "opening_balance": pl.Float64,
-            "debit": pl.Float64,
-            "credit": pl.Float64,
-            "closing_balance": pl.Float64,
-            "activity": pl.Float64
-        }
-    ).sort("period")
-
-
-def income_statement_section(df: pl.DataFrame, from_period_selection: datetime, to_period_selection: datetime):
-    df = df.filter(
-        (pl.col("period").is_between(from_period_selection, to_period_selection)) &
-        (pl.col("gl_account_code").str.contains("^[4-9]"))  # P&L accounts only
+def build_statement(statement: Statement, from_period_selection: datetime, to_period_selection: datetime,
+                    entity_selection: tuple[str, ...] | None, scenario_selection: Scenario | None):
+    if scenario_selection is None:
+        return statements.build_statement(statement, from_period_selection, to_period_selection, data_loader.data_version(), entity_selection)
+    return statements.build_variance_statement(
+        statement,
+        scenario_selection,
+        from_period_selection,
+        to_period_selection,
+        data_loader.scenario_versions([Scenario.ACTUAL, scenario_selection]),
+        entity_selection
     )
 
-    df = df.pivot(
-        on="period",
-        index=["gl_account_code", "gl_account_description"],
-        values="activity"
-    )
-
-    period_columns = [column for column in df.columns if column not in ["gl_account_code", "gl_account_description"]]
-
-    revenue_accounts = df.filter(pl.col("gl_account_code").str.starts_with("4")).with_columns([pl.col(column) * -1 for column in period_columns])
-    cost_of_goods_sold_accounts = df.filter(pl.col("gl_account_code").str.starts_with("5"))
-    operating_expense_accounts = df.filter(pl.col("gl_account_code").str.contains("^[6-9]"))
-
-    total_revenue = (revenue_accounts.select(period_columns).sum()).with_columns(
-        pl.lit(None).alias("gl_account_code"),
-        pl.lit(IncomeStatementCategory.TOTAL_REVENUE.value).alias("gl_account_description")
-    ).select(["gl_account_code", "gl_account_description"] + period_columns)
-
-    total_cost_of_goods_sold = cost_of_goods_sold_accounts.select(period_columns).sum().with_columns(
-        pl.lit(None).alias("gl_account_code"),
-        pl.lit(IncomeStatementCategory.TOTAL_COST_OF_GOODS_SOLD.value).alias("gl_account_description")
-    ).select(["gl_account_code", "gl_account_description"] + period_columns)
-
-    gross_profit = (total_revenue.select(period_columns) - total_cost_of_goods_sold.select(period_columns)).with_columns(
-        pl.lit(None).alias("gl_account_code"),
-        pl.lit(IncomeStatementCategory.GROSS_PROFIT.value).alias("gl_account_description")
-    ).select(["gl_account_code", "gl_account_description"] + period_columns)
-
-    total_operating_expenses = operating_expense_accounts.select(period_columns).sum().with_columns(
-        pl.lit(None).alias("gl_account_code"),
-        pl.lit(IncomeStatementCategory.TOTAL_OPERATING_EXPENSES.value).alias("gl_account_description")
-    ).select(["gl_account_code", "gl_account_description"] + period_columns)
-
-    net_profit = (gross_profit.select(period_columns) - total_operating_expenses.select(period_columns)).with_columns(
-        pl.lit(None).alias("gl_account_code"),
-        pl.lit(IncomeStatementCategory.NET_PROFIT.value).alias("gl_account_description")
-    ).select(["gl_account_code", "gl_account_description"] + period_columns)
-
-    df = pl.concat([
-        revenue_accounts,
-        total_revenue, 
-        cost_of_goods_sold_accounts,
-        total_cost_of_goods_sold, 
-        gross_profit, 
-        operating_expense_accounts,
-        total_operating_expenses, 
-        net_profit
-    ])
-
-    df = df.drop("gl_account_code")
-
-    styled_df = df.to_pandas().style.apply(
-        lambda row: utils.highlight_subtotal_row(row, "gl_account_description", [category.value for category in IncomeStatementCategory]), 
-        axis=1
-    )
 
-    center.dataframe(
-        styled_df,
-        height=utils.calculate_dataframe_height(df.shape[0] + 1),
-        width=min(150 * df.shape[1], 1200),
+def statement_section(container: DeltaGenerator, statement: Statement, from_period_selection: datetime, to_period_selection: datetime,
+                      entity_selection: tuple[str, ...] | None, scenario_selection: Scenario | None):
+    df = build_statement(statement, from_period_selection, to_period_selection, entity_selection, scenario_selection)
+    value_columns = [column for column in df.columns if column not in ["gl_account_code", "gl_account_description", "is_subtotal"]]
+    drill_down = statement in DRILL_DOWN_STATEMENTS
+
+    flagged_cells = anomalies.flag_cells(df, data_loader.fetch_anomalies(from_period_selection, to_period_selection, entity_selection))
+    styled_df = utils.highlight_subtotal_rows(df, flagged_cells=flagged_cells)
+
+    with instrumentation.stage("render") as record:
+        event = container.dataframe(
+            styled_df,
+            height=utils.calculate_dataframe_height(df.shape[0] + 1),
+            width=min(150 * (len(value_columns) + 1), 1200),
+            column_config={
+                "gl_account_code": None,
+                "gl_account_description": "",
+                **{column: st.column_config.NumberColumn(
+                    label=pl.Series([column]).str.to_datetime().dt.strftime("%b %Y").item() if scenario_selection is None else column,
+                    format="percent" if column == statements.VARIANCE_RATIO_COLUMN else "accounting"
+                ) for column in value_columns}
+            },
+            hide_index=True,
+            on_select="rerun" if drill_down else "ignore",
+            selection_mode="single-row",
+            key=f"statement_{statement.name}"
+        )
+        record["rows"] = df.height
+
+    if flagged_cells.select(pl.any_horizontal(pl.all()).any()).item():
+        container.caption("Highlighted amounts are unusual activity for their account, listed on the executive summary.")
+    if scenario_selection is not None:
+        container.caption(f"Compared with the {scenario_selection.value.lower()}: flows are totalled over the date range and balances taken at its end.")
+    if drill_down:
+        container.caption("Select an account or subtotal to see its history.")
+        if event.selection.rows:
+            account_history_section(container, statement, df.row(event.selection.rows[0], named=True), entity_selection)
+
+
+def account_history_section(container: DeltaGenerator, statement: Statement, row: dict, entity_selection: tuple[str, ...] | None):
+    with instrumentation.stage("drill-down") as record:
+        df = data_loader.fetch_account_history(statements.drill_down_accounts(statement, row, entity_selection), entity_selection)
+        record["rows"] = df.height
+
+    container.subheader(row["gl_account_description"])
+    container.dataframe(
+        df,
+        height=utils.calculate_dataframe_height(min(df.height, 24) + 1),
         column_config={
-            "gl_account_description": "",
+            "gl_account_code": "Account",
+            "gl_account_description": "Description",
+            "period": st.column_config.DateColumn(label="Period", format="MMM YYYY"),
             **{column: st.column_config.NumberColumn(
-                label=pl.Series([column]).str.to_datetime().dt.strftime("%b %Y").item(),
+                label=column.replace("_", " ").capitalize(),
                 format="accounting"
-            ) for column in period_columns}
+            ) for column in ["debit", "credit", "activity", "closing_balance"]}
         },
         hide_index=True
     )
 
 
-def balance_sheet_section(df: pl.DataFrame, from_period_selection: datetime, to_period_selection: datetime):
-    df = df.filter(
-        (pl.col("period").is_between(from_period_selection, to_period_selection)) &
-        (pl.col("gl_account_code").str.contains("^[1-3]"))  # Balance sheet accounts only
-    )
-
-    df = df.pivot(
-        on="period",
-        index=["gl_account_code", "gl_account_description"],
-        values="closing_balance"
-    )
-
-    period_columns = [column for column in df.columns if column not in ["gl_account_code", "gl_account_description"]]
-
-    asset_accounts = df.filter(pl.col("gl_account_code").str.starts_with("1"))
-    liability_accounts = df.filter(pl.col("gl_account_code").str.starts_with("2"))
-    equity_accounts = df.filter(pl.col("gl_account_code").str.starts_with("3"))
-
-    total_assets = (asset_accounts.select(period_columns).sum()).with_columns(
-        pl.lit(None).alias("gl_account_code"),
-        pl.lit(BalanceSheetCategory.TOTAL_ASSETS.value).alias("gl_account_description")
-    ).select(["gl_account_code", "gl_account_description"] + period_columns)
-
-    total_liabilities = (liability_accounts.select(period_columns).sum()).with_columns(
-        pl.lit(None).alias("gl_account_code"),
-        pl.lit(BalanceSheetCategory.TOTAL_LIABILITIES.value).alias("gl_account_description")
-    ).select(["gl_account_code", "gl_account_description"] + period_columns)
-
-    total_equity = (equity_accounts.select(period_columns).sum()).with_columns(
-        pl.lit(None).alias("gl_account_code"),
-        pl.lit(BalanceSheetCategory.TOTAL_EQUITY.value).alias("gl_account_description")
-    ).select(["gl_account_code", "gl_account_description"] + period_columns)
-
-    df = pl.concat([
-        asset_accounts,
-        total_assets,
-        liability_accounts,
-        total_liabilities,
-        equity_accounts,
-        total_equity
-    ])
-
-    df = df.drop("gl_account_code")
-
-    styled_df = df.to_pandas().style.apply(
-        lambda row: utils.highlight_subtotal_row(row, "gl_account_description", [category.value for category in BalanceSheetCategory]),
-        axis=1
-    )
-
-    center.dataframe(
-        styled_df,
-        height=utils.calculate_dataframe_height(df.shape[0] + 1),
-        width=min(150 * df.shape[1], 1200),
-        column_config={
-            "gl_account_description": "",
-            **{column: st.column_config.NumberColumn(
-                label=pl.Series([column]).str.to_datetime().dt.strftime("%b %Y").item(),
-                format="accounting"
-            ) for column in period_columns}
-        },
-        hide_index=True
-    )
-
-
-def cash_flow_statement_section(df: pl.DataFrame, from_period_selection: datetime, to_period_selection: datetime):
-    left_center.info("This statement has not been implemented yet.")
+# Selecting a row only reruns the statement and its drill-down
+@st.fragment
+def statement_fragment(statement: Statement, from_period_selection: datetime, to_period_selection: datetime,
+                       entity_selection: tuple[str, ...] | None, scenario_selection: Scenario | None):
+    with utils.page_run("financial_statements.statement"):
+        statement_section(st.container(), statement, from_period_selection, to_period_selection, entity_selection, scenario_selection)
+
+
+@st.fragment
+def export_section(statement: Statement, from_period_selection: datetime, to_period_selection: datetime, entity_selection: tuple[str, ...] | None,
+                   scenario_selection: Scenario | None):
+    with utils.page_run("financial_statements.export"):
+        df = build_statement(statement, from_period_selection, to_period_selection, entity_selection, scenario_selection)
+
+        popover = st.popover(label="Export", icon=":material/download:")
+        export_format = popover.radio(
+            label="Format",
+            options=list(ExportFormat),
+            format_func=lambda x: x.value,
+            horizontal=True
+        )
+        # The file is only written when the button is clicked, on a separate thread from the script run
+        popover.download_button(
+            label="Download",
+            data=lambda: exports.export_statement(df, statement, export_format),
+            file_name=(
+                f"{statement.value}{'' if scenario_selection is None else f' vs {scenario_selection.value}'} "
+                f"{from_period_selection:%Y-%m} to {to_period_selection:%Y-%m}.{EXPORT_CONSTANTS[export_format]['extension']}"
+            ),
+            mime=EXPORT_CONSTANTS[export_format]["mime"],
+            on_click="ignore"
+        )
+
+
+@st.fragment
+def financial_statements_fragment():
+    with utils.page_run("financial_statements"):
+        financial_statement_selection = st.pills(
+            label="Statement",
+            options=list(Statement),
+            default=Statement.INCOME_STATEMENT,
+            format_func=lambda x: x.value
+        )
+
+        left_center, center_center, right_center = st.columns(3)
+
+        period_options = utils.session_cached("period_options", data_loader.fetch_periods)
+        from_period_selection, to_period_selection = left_center.select_slider(
+            label="Date range",
+            options=(period_options),
+            value=(period_options[-6], period_options[-1]),
+            format_func=lambda x: datetime.strftime(x, "%B %Y")
+        )
+
+        entity_selection = utils.select_entities(center_center)
+        scenario_selection = utils.select_plan(center_center)
+
+        if financial_statement_selection is not None:
+            statement_fragment(financial_statement_selection, from_period_selection, to_period_selection, entity_selection, scenario_selection)
+            with right_center:
+                export_section(financial_statement_selection, from_period_selection, to_period_selection, entity_selection, scenario_selection)
+
+        utils.data_as_of_section(st.container())
 
 
 # =======================
@@ -182,29 +167,7 @@ st.set_page_config(
 left, center, right = st.columns([1, 7, 1])
 center.header(":material/article: Financial statements")
 
-df = fetch_data()
-
-financial_statement_selection = center.pills(
-    label="Statement",
-    options=["Income Statement", "Balance Sheet"],
-    default="Income Statement"
-)
-
-left_center, center_center, right_center = center.columns(3)
-
-period_options = df["period"].unique().to_list()
-from_period_selection, to_period_selection = left_center.select_slider(
-    label="Date range",
-    options=(period_options),
-    value=(period_options[-6], period_options[-1]),
-    format_func=lambda x: datetime.strftime(x, "%B %Y")
-)
-
-if financial_statement_selection == "Income Statement":
-    income_statement_section(df, from_period_selection, to_period_selection)
-elif financial_statement_selection == "Balance Sheet":
-    balance_sheet_section(df, from_period_selection, to_period_selection)
-elif financial_statement_selection == "Cash Flow Statement":
-    cash_flow_statement_section(df, from_period_selection, to_period_selection)
+with center:
+    financial_statements_fragment()
 
-center.badge(f"Latest data: {datetime.now(tz=ZoneInfo("America/New_York")):%B %e, %Y}", color="grey")
\ No newline at end of file
+utils.validation_section(center)
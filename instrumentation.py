@@ -0,0 +1,87 @@
+"""
+Per-run timing instrumentation.
+
+A page starts a run, code on the hot path wraps its stages in stage(), and finishing the run
+appends the timings to a JSON lines log, rotated once it reaches INSTRUMENTATION_LOG_MAX_BYTES.
+Stages outside a run are not recorded, so the compute modules can be used headless (e.g. by
+benchmark.py) without any setup.
+
+Author: Yakir Havin
+"""
+
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from constants import INSTRUMENTATION_LOG_BACKUPS, INSTRUMENTATION_LOG_MAX_BYTES, INSTRUMENTATION_LOG_PATH
+
+
+_local = threading.local()  # Streamlit runs each session's script on its own thread
+_loggers: dict[str, logging.Logger] = {}
+_loggers_lock = threading.Lock()
+
+
+def run_logger(log_path: str) -> logging.Logger:
+    """Return the logger writing runs to a log file, created once per path. Its handler serializes writes across threads."""
+    with _loggers_lock:
+        if log_path not in _loggers:
+            os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+            handler = RotatingFileHandler(log_path, maxBytes=INSTRUMENTATION_LOG_MAX_BYTES, backupCount=INSTRUMENTATION_LOG_BACKUPS, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger = logging.getLogger(f"{__name__}.{len(_loggers)}")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(handler)
+            _loggers[log_path] = logger
+        return _loggers[log_path]
+
+
+def start_run(page: str):
+    """Start recording stages for a page run on this thread."""
+    _local.run = {
+        "page": page,
+        "started_at": datetime.now().isoformat(timespec="milliseconds"),
+        "start": time.perf_counter(),
+        "stages": []
+    }
+
+
+def active() -> bool:
+    """Return whether a run is being recorded on this thread."""
+    return getattr(_local, "run", None) is not None
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a block as a stage of the current run. Yields a dict that the block can set "rows" on.
+    Does nothing beyond timing when no run is active.
+    """
+    record = {"stage": name, "rows": None}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        run = getattr(_local, "run", None)
+        if run is not None:
+            run["stages"].append(record)
+
+
+def finish_run(log_path: str=INSTRUMENTATION_LOG_PATH) -> dict | None:
+    """Stop the current run, append it to the log (unless log_path is empty) and return it."""
+    run = getattr(_local, "run", None)
+    if run is None:
+        return None
+    _local.run = None
+
+    run["total_seconds"] = time.perf_counter() - run.pop("start")
+    if log_path:
+        run_logger(log_path).info(json.dumps(run, default=str))
+    return run
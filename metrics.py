@@ -0,0 +1,201 @@
+"""
+Metric calculations.
+
+Author: Yakir Havin
+"""
+
+
+from datetime import date
+
+import polars as pl
+
+import instrumentation
+from constants import (
+    AccountClass,
+    Comparison,
+    Granularity,
+    Metric,
+    MetricBasis,
+    Scenario,
+    COMPARISON_MONTHS,
+    COMPARISON_SCENARIOS,
+    GRANULARITY_CONSTANTS,
+    INCOME_STATEMENT_ACCOUNT_CLASSES,
+    TRAILING_MONTHS
+)
+
+
+def safe_divide(numerator: pl.Expr, denominator: pl.Expr) -> pl.Expr:
+    """Divide two expressions, returning 0 where the denominator is not positive (and null where it is null)."""
+    return pl.when(denominator > 0).then(numerator / denominator).when(denominator <= 0).then(0.0)
+
+
+def variance(actual: pl.Expr, plan: pl.Expr) -> pl.Expr:
+    """Return how far actuals are above a plan (a budget or forecast)."""
+    return actual - plan
+
+
+def variance_ratio(actual: pl.Expr, plan: pl.Expr) -> pl.Expr:
+    """Return the variance as a ratio of the plan's size, null where nothing was planned."""
+    return pl.when(plan != 0).then(variance(actual, plan) / plan.abs())
+
+
+def calculate_metrics(lf: pl.LazyFrame, from_period: date | None=None, to_period: date | None=None,
+                      granularity: Granularity=Granularity.MONTH) -> pl.DataFrame:
+    """
+    Calculate every metric on every basis for every period (and scenario, when the frame has a scenario column as
+    labelled by data_loader.scan_scenario; actuals otherwise) in a single aggregation.
+    Returns one row per scenario, period and basis with scenario and basis columns and a column per metric, named by the
+    metric's value.
+    Year to date and trailing twelve month totals are window expressions over the monthly totals, which are read from
+    far enough before from_period to fill the windows; a trailing total without twelve months of history is null, and
+    so are the monthly amounts of a month missing inside the range.
+    With a coarser granularity, periods are quarters or years (labelled by their first month) starting with the one
+    that contains from_period.
+    """
+    if from_period is not None:
+        lf = lf.filter(pl.col("period") >= offset_period(from_period, 1 - TRAILING_MONTHS))
+    if to_period is not None:
+        lf = lf.filter(pl.col("period") <= to_period)
+    if "scenario" not in lf.collect_schema().names():
+        lf = lf.with_columns(pl.lit(Scenario.ACTUAL.value).alias("scenario"))
+
+    class_column = pl.col("account_class")
+    activity = pl.col("activity")
+
+    with instrumentation.stage("metrics aggregation") as record:
+        totals = lf.filter(
+            class_column.is_in([account_class.value for account_class in INCOME_STATEMENT_ACCOUNT_CLASSES])
+        ).group_by("scenario", "period").agg(
+            (activity.filter(class_column == AccountClass.REVENUE.value).sum() * -1).alias("revenue"),
+            activity.filter(class_column == AccountClass.COST_OF_GOODS_SOLD.value).sum().alias("cost_of_goods_sold"),
+            activity.filter(class_column == AccountClass.OPERATING_EXPENSES.value).sum().alias("operating_expenses")
+        ).sort("scenario", "period").collect()
+        record["rows"] = totals.height
+
+    with instrumentation.stage("metrics windows") as record:
+        components = pl.col("revenue", "cost_of_goods_sold", "operating_expenses")
+        reported = pl.col("reported")
+        totals = totals.with_columns(pl.lit(True).alias("reported"))
+        if not totals.is_empty():
+            # Row offsets are month offsets within each scenario from here on. Months missing inside the range add
+            # nothing to cumulative and trailing totals, but have no amounts of their own
+            totals = totals.upsample("period", every="1mo", group_by="scenario", maintain_order=True).with_columns(
+                components.fill_null(0), reported.fill_null(False)
+            )
+
+        windows = {
+            MetricBasis.MONTH: pl.when(reported).then(components),
+            MetricBasis.YEAR_TO_DATE: components.cum_sum().over("scenario", pl.col("period").dt.year()),
+            MetricBasis.TRAILING_TWELVE_MONTHS: components.rolling_sum(TRAILING_MONTHS).over("scenario")
+        }
+        frames = []
+        for basis, window in windows.items():
+            basis_df = totals.select("scenario", "period", "reported", window)
+            if granularity != Granularity.MONTH:
+                # Monthly amounts add up over a quarter or year; cumulative and trailing totals stand at its last month
+                basis_df = basis_df.group_by(
+                    "scenario", pl.col("period").dt.truncate(GRANULARITY_CONSTANTS[granularity]["every"]), maintain_order=True
+                ).agg(
+                    pl.when(reported.any()).then(components.sum()) if basis == MetricBasis.MONTH else components.last()
+                )
+            frames.append(basis_df.select(pl.exclude("reported"), pl.lit(basis.value).alias("basis")))
+
+        metrics_df = pl.concat(frames).with_columns(
+            (pl.col("revenue") - pl.col("cost_of_goods_sold")).alias("gross_profit")
+        ).with_columns(
+            (pl.col("gross_profit") - pl.col("operating_expenses")).alias("net_profit")
+        ).select(
+            "scenario",
+            "period",
+            "basis",
+            pl.col("revenue").alias(Metric.REVENUE.value),
+            pl.col("gross_profit").alias(Metric.GROSS_PROFIT.value),
+            pl.col("operating_expenses").alias(Metric.OPERATING_EXPENSES.value),
+            pl.col("net_profit").alias(Metric.NET_PROFIT.value),
+            safe_divide(pl.col("gross_profit"), pl.col("revenue")).alias(Metric.GROSS_PROFIT_RATIO.value),
+            safe_divide(pl.col("operating_expenses"), pl.col("revenue")).alias(Metric.OPERATING_EXPENSE_RATIO.value)
+        )
+        if from_period is not None:
+            metrics_df = metrics_df.filter(pl.col("period") >= truncate_period(from_period, granularity))
+        record["rows"] = metrics_df.height
+    return metrics_df
+
+
+def period_metrics(metrics_df: pl.DataFrame, period: date, scenario: Scenario=Scenario.ACTUAL) -> dict[Metric, float | None]:
+    """Look up every metric of a scenario for one period, all None when the period is missing (e.g. before the data starts)."""
+    rows = metrics_df.filter((pl.col("scenario") == scenario.value) & (pl.col("period") == period))
+    if rows.is_empty():
+        return {metric: None for metric in Metric}
+    return {metric: rows[metric.value].item() for metric in Metric}
+
+
+def offset_period(period: date, months: int) -> date:
+    """Return the period (first day of the month) a number of months before or after a period."""
+    month = period.year * 12 + period.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def truncate_period(period: date, granularity: Granularity) -> date:
+    """Return the first month of the quarter or year (per granularity) that contains a period."""
+    months = GRANULARITY_CONSTANTS[granularity]["months"]
+    return date(period.year, (period.month - 1) // months * months + 1, 1)
+
+
+def summarize_period(lf: pl.LazyFrame, period: date, basis: MetricBasis=MetricBasis.MONTH,
+                     comparison: Comparison=Comparison.PRIOR_MONTH) -> dict[Metric, dict[str, float | None]]:
+    """
+    Return the value of every metric for a period on a basis, and its change since the comparison period or its
+    variance from the same period's budget or forecast (whose rows the frame must include, see
+    data_loader.scan_scenario), also as a ratio of the amount compared with.
+    Values and changes are None where a trailing window lacks history or the comparison period has no data.
+    """
+    scenario = COMPARISON_SCENARIOS.get(comparison, Scenario.ACTUAL)
+    comparison_period = period if comparison in COMPARISON_SCENARIOS else offset_period(period, -COMPARISON_MONTHS[comparison])
+    metrics_df = calculate_metrics(lf, comparison_period, period).filter(pl.col("basis") == basis.value)
+    selected = period_metrics(metrics_df, period)
+    prior = period_metrics(metrics_df, comparison_period, scenario)
+
+    summary = {}
+    for metric in Metric:
+        delta = selected[metric] - prior[metric] if selected[metric] is not None and prior[metric] is not None else None
+        summary[metric] = {
+            "value": selected[metric],
+            "delta": delta,
+            "delta_ratio": delta / abs(prior[metric]) if delta is not None and prior[metric] else None
+        }
+    return summary
+
+
+def metric_series(lf: pl.LazyFrame, metric_selection: list[Metric], from_period: date, to_period: date,
+                  basis: MetricBasis=MetricBasis.MONTH, granularity: Granularity=Granularity.MONTH,
+                  scenario: Scenario | None=None) -> pl.DataFrame:
+    """
+    Return metrics on a basis for each period in a range (at a granularity) in long format,
+    as period, metric (the metric's value), value and prior_year_value columns.
+    Given a budget or forecast scenario (whose rows the frame must include, see data_loader.scan_scenario), the actuals
+    are joined to it in plan_value, variance and variance_ratio columns.
+    """
+    prior_year_months = COMPARISON_MONTHS[Comparison.PRIOR_YEAR]
+    prior_year_periods = prior_year_months // GRANULARITY_CONSTANTS[granularity]["months"]
+    df = calculate_metrics(lf, offset_period(from_period, -prior_year_months), to_period, granularity).filter(
+        pl.col("basis") == basis.value
+    ).unpivot(
+        index=["scenario", "period"],
+        on=[metric.value for metric in metric_selection],
+        variable_name="metric",
+        value_name="value"
+    ).with_columns(
+        pl.col("value").shift(prior_year_periods).over("scenario", "metric").alias("prior_year_value")
+    ).filter(
+        pl.col("period") >= truncate_period(from_period, granularity)
+    )
+
+    actual = df.filter(pl.col("scenario") == Scenario.ACTUAL.value).drop("scenario")
+    if scenario is None:
+        return actual
+    plan = df.filter(pl.col("scenario") == scenario.value).select("period", "metric", pl.col("value").alias("plan_value"))
+    return actual.join(plan, on=["period", "metric"], how="left", maintain_order="left").with_columns(
+        variance(pl.col("value"), pl.col("plan_value")).alias("variance"),
+        variance_ratio(pl.col("value"), pl.col("plan_value")).alias("variance_ratio")
+    )
@@ -1,100 +1,79 @@
 from datetime import datetime
-from zoneinfo import ZoneInfo
 
 import streamlit as st
-import polars as pl
-import altair as alt
+from streamlit.delta_generator import DeltaGenerator
 
-from constants import Metric, METRIC_CONSTANTS
+import charts
+import data_loader
+import instrumentation
+import utils
+from constants import Metric, MetricBasis, Scenario, METRIC_CONSTANTS
 
 
 # =======================
 # Functions
 # =======================
-# @st.cache_data(show_spinner=False)
-def fetch_data():
-    return pl.read_csv(
-        "data/trial_balance.csv",
-        schema_overrides={
-            "period": pl.Date,
-            "gl_account_code": pl.Utf8,
-            "opening_balance": pl.Float64,
-            "debit": pl.Float64,
-            "credit": pl.Float64,
-            "closing_balance": pl.Float64,
-            "activity": pl.Float64
-        }
-    ).sort("period")
-
-
-def performance_explorer_section(df: pl.DataFrame, metric_selection: Metric, from_period_selection: datetime, to_period_selection: datetime):
-    df = df.filter(
-        (pl.col("period").is_between(from_period_selection, to_period_selection)) &
-        pl.col("gl_account_code").str.contains("^[4-9]")
-    )
-
-    periods = df["period"].unique().to_list()
-
-    metric_data = []
-    for period in periods:
-        period_df = df.filter(pl.col("period") == period)
-
-        revenue = period_df.filter(
-            pl.col("gl_account_code").str.starts_with("4")
-        ).select(pl.col("activity").sum()).item() * -1
-
-        cost_of_goods_sold = period_df.filter(
-            pl.col("gl_account_code").str.starts_with("5")
-        ).select(pl.col("activity").sum()).item()
-
-        operating_expenses = period_df.filter(
-            pl.col("gl_account_code").str.contains("^[6-9]")
-        ).select(pl.col("activity").sum()).item()
-
-        gross_profit = revenue - cost_of_goods_sold
-        net_profit = gross_profit - operating_expenses
-
-        if metric_selection == Metric.REVENUE:
-            value = revenue
-        elif metric_selection == Metric.GROSS_PROFIT:
-            value = gross_profit
-        elif metric_selection == Metric.OPERATING_EXPENSES:
-            value = operating_expenses
-        elif metric_selection == Metric.NET_PROFIT:
-            value = net_profit
-        elif metric_selection == Metric.GROSS_PROFIT_RATIO:
-            value = gross_profit / revenue if revenue > 0 else 0
-        elif metric_selection == Metric.OPERATING_EXPENSE_RATIO:
-            value = operating_expenses / revenue if revenue > 0 else 0
-
-        metric_data.append({"period": period, "value": value})
-
-    df = pl.DataFrame(metric_data)
-    
-    chart = alt.Chart(df).mark_line(point=True).encode(
-        x=alt.X(
-            "yearmonth(period):T",
-            title=None,
-            axis=alt.Axis(
-                format="%B %Y",
-                labelAngle=-45,
-                labelAlign="right",
-                labelOverlap=False
-            ),
-        ),
-        y=alt.Y(
-            "value:Q",
-            title=None,
-            axis=alt.Axis(format=METRIC_CONSTANTS[metric_selection]["format"]["axis"])
-        ),
-        tooltip=[
-            alt.Tooltip("period:T", title="Period", format="%B %Y"),
-            alt.Tooltip("value:Q", title=metric_selection.value, format=METRIC_CONSTANTS[metric_selection]["format"]["tooltip"])
-        ]
-    )
-
-    with center.container(border=True):
-        st.altair_chart(chart)
+def performance_explorer_section(container: DeltaGenerator, metric_selection: list[Metric], from_period_selection: datetime, to_period_selection: datetime,
+                                 basis_selection: MetricBasis, prior_year_selection: bool, scenario_selection: Scenario | None,
+                                 entity_selection: tuple[str, ...] | None):
+    with instrumentation.stage("chart") as record:
+        spec = charts.build_metric_chart(
+            tuple(metric_selection),
+            from_period_selection,
+            to_period_selection,
+            basis_selection,
+            prior_year_selection,
+            entity_selection,
+            data_loader.data_version() if scenario_selection is None else data_loader.scenario_versions([Scenario.ACTUAL, scenario_selection]),
+            scenario_selection
+        )
+        record["rows"] = spec["datasets"][charts.CHART_DATASET].height
+
+    with instrumentation.stage("render") as record, container.container(border=True):
+        st.vega_lite_chart(spec)
+        record["rows"] = spec["datasets"][charts.CHART_DATASET].height
+
+
+# Every control changes the chart, its only section, so they rerun together
+@st.fragment
+def performance_explorer_fragment():
+    with utils.page_run("performance_explorer"):
+        left_center, center_center, right_center = st.columns(3)
+
+        period_options = utils.session_cached("period_options", data_loader.fetch_periods)
+        from_period_selection, to_period_selection = left_center.select_slider(
+            label="Date range",
+            options=(period_options),
+            value=(period_options[-12], period_options[-1]),
+            format_func=lambda x: datetime.strftime(x, "%B %Y")
+        )
+
+        metric_selection = left_center.multiselect(
+            label="Metrics",
+            options=list(Metric),
+            default=[Metric.REVENUE],
+            format_func=lambda x: x.value
+        )
+        for metric in metric_selection:
+            left_center.caption(body=f"{metric.value}: {METRIC_CONSTANTS[metric]['caption']}")
+
+        basis_selection = left_center.selectbox(
+            label="Basis",
+            options=list(MetricBasis),
+            format_func=lambda x: x.value
+        )
+
+        prior_year_selection = left_center.toggle(label="Compare with prior year")
+
+        scenario_selection = utils.select_plan(left_center)
+        entity_selection = utils.select_entities(center_center)
+
+        if metric_selection:
+            performance_explorer_section(st.container(), metric_selection, from_period_selection, to_period_selection, basis_selection, prior_year_selection, scenario_selection, entity_selection)
+        else:
+            st.info("Select at least one metric.")
+
+        utils.data_as_of_section(st.container())
 
 
 # =======================
@@ -104,27 +83,11 @@ st.set_page_config(
     page_title="Performance explorer | Executive Portal",
     layout="wide"
 )
+
 left, center, right = st.columns([1, 5, 1])
 center.header(":material/explore: Performance explorer")
-left_center, center_center, right_center = center.columns(3)
-
-df = fetch_data()
-
-period_options = df["period"].unique().to_list()
-from_period_selection, to_period_selection = left_center.select_slider(
-    label="Date range",
-    options=(period_options),
-    value=(period_options[-12], period_options[-1]),
-    format_func=lambda x: datetime.strftime(x, "%B %Y")
-)
-
-metric_selection = left_center.selectbox(
-    label="Metric",
-    options=list(Metric),
-    format_func=lambda x: x.value
-)
-left_center.caption(body=METRIC_CONSTANTS[metric_selection]["caption"])
 
-performance_explorer_section(df, metric_selection, from_period_selection, to_period_selection)
+with center:
+    performance_explorer_fragment()
 
-center.badge(f"Latest data: {datetime.now(tz=ZoneInfo("America/New_York")):%B %e, %Y}", color="grey")
\ No newline at end of file
+utils.validation_section(center)
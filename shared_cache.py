@@ -0,0 +1,100 @@
+"""
+Process-wide cache of results derived from the trial balance (statements and chart specs),
+shared by every session so memory doesn't grow with the number of users.
+
+Entries are keyed by the data version (or versions, for results that compare stores) they were derived
+from and are evicted least recently used once the cache outgrows SHARED_CACHE_MAX_BYTES, or as soon as
+one of their data versions is no longer live (neither current nor pinned by a page run). Cached values
+are shared, so callers must not mutate them.
+
+Author: Yakir Havin
+"""
+
+
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Callable
+
+import polars as pl
+
+from constants import SHARED_CACHE_MAX_BYTES
+
+
+# {(namespace, data version, key): (value, size in bytes)}
+_entries: OrderedDict[tuple, tuple[Any, int]] = OrderedDict()
+_stats: dict[str, dict[str, int]] = {}
+_lock = threading.Lock()
+
+
+def estimated_size(value: Any) -> int:
+    """Estimate the memory held by a value: frames report their buffers and containers add up their items."""
+    if isinstance(value, (pl.DataFrame, pl.Series)):
+        return value.estimated_size()
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimated_size(item) for item in value.values())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(estimated_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+def get_or_compute(namespace: str, key: tuple, data_version: str | tuple[str, ...], compute: Callable[[], Any]) -> Any:
+    """
+    Return the cached value for a key at a data version, computing and caching it on a miss.
+    Computation happens outside the lock, so concurrent misses on the same key may both compute it.
+    """
+    entry_key = (namespace, data_version, key)
+    with _lock:
+        stats = _stats.setdefault(namespace, {"hits": 0, "misses": 0})
+        if entry_key in _entries:
+            _entries.move_to_end(entry_key)
+            stats["hits"] += 1
+            return _entries[entry_key][0]
+        stats["misses"] += 1
+
+    value = compute()
+
+    with _lock:
+        _entries[entry_key] = (value, estimated_size(value))
+        _evict()
+    return value
+
+
+def retain_versions(data_versions: set[str]):
+    """Drop every entry derived from a data version that is not in a set of live versions."""
+    with _lock:
+        for entry_key in [entry_key for entry_key in _entries if not set(_versions(entry_key[1])) <= data_versions]:
+            del _entries[entry_key]
+
+
+def clear(namespace: str | None=None):
+    """Drop every entry, or those of one namespace."""
+    with _lock:
+        for entry_key in [entry_key for entry_key in _entries if namespace is None or entry_key[0] == namespace]:
+            del _entries[entry_key]
+
+
+def cache_info() -> pl.DataFrame:
+    """Return the entries, bytes, hits and misses of each namespace."""
+    with _lock:
+        sizes = {}
+        for (namespace, _, _), (_, size) in _entries.items():
+            entries, total = sizes.get(namespace, (0, 0))
+            sizes[namespace] = (entries + 1, total + size)
+        rows = [
+            {"namespace": namespace, "entries": sizes.get(namespace, (0, 0))[0], "bytes": sizes.get(namespace, (0, 0))[1], **stats}
+            for namespace, stats in sorted(_stats.items())
+        ]
+    return pl.DataFrame(rows, schema={"namespace": pl.Utf8, "entries": pl.Int64, "bytes": pl.Int64, "hits": pl.Int64, "misses": pl.Int64})
+
+
+def _versions(data_version: str | tuple[str, ...]) -> tuple[str, ...]:
+    return data_version if isinstance(data_version, tuple) else (data_version,)
+
+
+def _evict():
+    """Evict least recently used entries until the cache fits SHARED_CACHE_MAX_BYTES (always keeps the newest)."""
+    total = sum(size for _, size in _entries.values())
+    while len(_entries) > 1 and total > SHARED_CACHE_MAX_BYTES:
+        _, (_, size) = _entries.popitem(last=False)
+        total -= size
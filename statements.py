@@ -0,0 +1,236 @@
+"""
+Financial statement builders.
+
+Author: Yakir Havin
+"""
+
+
+from datetime import date
+from functools import partial
+
+import polars as pl
+
+import data_loader
+import instrumentation
+import metrics
+import shared_cache
+from constants import (
+    CashFlowActivity,
+    IncomeStatementCategory,
+    Scenario,
+    Statement,
+    BALANCE_SHEET_ACCOUNT_CLASSES,
+    CASH_ACCOUNTS,
+    CASH_FLOW_ACTIVITIES,
+    RETAINED_EARNINGS_ACCOUNTS,
+    STATEMENT_LAYOUTS
+)
+
+
+VARIANCE_COLUMN = "Variance"
+VARIANCE_RATIO_COLUMN = "Variance %"
+
+
+def subtotal_coefficients(layout: dict) -> dict[int, dict[str, float]]:
+    """Resolve every subtotal in a layout to coefficients on classes, keyed by section position."""
+    coefficients = {}
+    by_subtotal = {}
+    for position, section in enumerate(layout["sections"]):
+        if "class" in section:
+            section_coefficients = {section["class"].value: 1}
+        else:
+            section_coefficients = {}
+            for subtotal, coefficient in section["formula"].items():
+                for class_value, class_coefficient in by_subtotal[subtotal].items():
+                    section_coefficients[class_value] = section_coefficients.get(class_value, 0) + coefficient * class_coefficient
+        coefficients[position] = by_subtotal[section["subtotal"]] = section_coefficients
+    return coefficients
+
+
+def build_layout(lf: pl.LazyFrame, layout: dict, from_period: date, to_period: date, column: str="period") -> pl.DataFrame:
+    """
+    Build a statement from a layout with a column per period (or per value of another column, totalling the periods),
+    ordered account and subtotal rows, their GL account code (null for subtotals) and an is_subtotal flag.
+    Entities are consolidated per account in the scan's (parallel) aggregation before pivoting, and all subtotals are
+    calculated in a single aggregation by joining accounts to the subtotals they roll into.
+    """
+    sections = layout["sections"]
+    signs = {section["class"].value: section.get("sign", 1) for section in sections if "class" in section}
+    positions = {section["class"].value: position for position, section in enumerate(sections) if "class" in section}
+
+    with instrumentation.stage("scan and filter") as record:
+        df = lf.filter(
+            (pl.col("period").is_between(from_period, to_period)) &
+            (pl.col(layout["class_column"]).cast(pl.Utf8).is_in(list(signs)))
+        ).select(
+            column,
+            "gl_account_code",
+            "gl_account_description",
+            pl.col(layout["class_column"]).cast(pl.Utf8).alias("class"),
+            (pl.col(layout["values"]) * pl.col(layout["class_column"]).cast(pl.Utf8).replace_strict(signs)).alias("value")
+        ).group_by(column, "gl_account_code", "gl_account_description", "class").agg(
+            pl.col("value").sum()
+        ).sort(column).collect()
+        record["rows"] = df.height
+
+    with instrumentation.stage("pivot") as record:
+        accounts = df.pivot(
+            on=column,
+            index=["gl_account_code", "gl_account_description", "class"],
+            values="value"
+        ).sort(pl.col("gl_account_code").cast(pl.Utf8), maintain_order=True)
+        record["rows"] = accounts.height
+    period_columns = [column for column in accounts.columns if column not in ["gl_account_code", "gl_account_description", "class"]]
+
+    memberships = pl.DataFrame(
+        [
+            {"class": class_value, "position": position, "coefficient": coefficient}
+            for position, section_coefficients in subtotal_coefficients(layout).items()
+            for class_value, coefficient in section_coefficients.items()
+        ],
+        schema={"class": pl.Utf8, "position": pl.Int64, "coefficient": pl.Float64}
+    )
+
+    with instrumentation.stage("subtotals") as record:
+        subtotals = df.join(memberships, on="class").group_by("position", column).agg(
+            (pl.col("value") * pl.col("coefficient")).sum()
+        ).pivot(
+            on=column,
+            index="position",
+            values="value"
+        )
+        record["rows"] = subtotals.height
+
+    subtotals = pl.DataFrame({
+        "position": list(range(len(sections))),
+        "gl_account_description": [section["subtotal"].value for section in sections]
+    }).join(subtotals, on="position", how="left").with_columns(
+        pl.col(period_columns).fill_null(0),
+        pl.lit(None, dtype=pl.Utf8).alias("gl_account_code"),
+        pl.lit(True).alias("is_subtotal")
+    )
+
+    accounts = accounts.with_columns(
+        pl.col("gl_account_code").cast(pl.Utf8),
+        pl.col("class").replace_strict(positions).alias("position"),
+        pl.lit(False).alias("is_subtotal")
+    )
+
+    return pl.concat(
+        [
+            accounts.select(["position", "gl_account_code", "gl_account_description"] + period_columns + ["is_subtotal"]),
+            subtotals.select(["position", "gl_account_code", "gl_account_description"] + period_columns + ["is_subtotal"])
+        ]
+    ).sort("position", "is_subtotal", maintain_order=True).drop("position")
+
+
+def cash_flow_sources(from_period: date, to_period: date, data_version: str, entities: tuple[str, ...] | None=None,
+                      scenario: Scenario=Scenario.ACTUAL) -> pl.LazyFrame:
+    """
+    Gather the lines of an indirect method cash flow statement for every period at once:
+    net profit, taken from the (cached) income statement, and the cash effect of each balance sheet
+    account's movement, which is the negative of its activity (a debit to an asset uses cash). Accounts outside the
+    investing and financing ranges of CASH_FLOW_ACTIVITIES are operating, so Net Change in Cash always reconciles
+    to the movement in the cash accounts.
+    """
+    net_profit = build_statement(Statement.INCOME_STATEMENT, from_period, to_period, data_version, entities, scenario).filter(
+        pl.col("is_subtotal") & (pl.col("gl_account_description") == IncomeStatementCategory.NET_PROFIT.value)
+    ).drop("gl_account_code", "is_subtotal").unpivot(
+        index="gl_account_description",
+        variable_name="period",
+        value_name="cash_flow"
+    ).select(
+        pl.col("period").str.to_date(),
+        pl.lit(None, dtype=pl.Utf8).alias("gl_account_code"),
+        "gl_account_description",
+        pl.lit(CashFlowActivity.OPERATING.value).alias("cash_flow_activity"),
+        "cash_flow"
+    )
+
+    code = pl.col("gl_account_code").cast(pl.Utf8).cast(pl.Int64, strict=False)
+    movements = data_loader.scan_scenario(partial(data_loader.scan_trial_balance, from_period, to_period), scenario, entities).filter(
+        pl.col("account_class").is_in([account_class.value for account_class in BALANCE_SHEET_ACCOUNT_CLASSES]) &
+        ~pl.any_horizontal(pl.lit(False), *[code.is_between(low, high) for low, high in CASH_ACCOUNTS + RETAINED_EARNINGS_ACCOUNTS])
+    ).select(
+        "period",
+        pl.col("gl_account_code").cast(pl.Utf8),
+        "gl_account_description",
+        data_loader.code_range_expression(CASH_FLOW_ACTIVITIES).fill_null(CashFlowActivity.OPERATING.value).alias("cash_flow_activity"),
+        (pl.col("activity") * -1).alias("cash_flow")
+    )
+
+    return pl.concat([net_profit.lazy(), movements])
+
+
+def statement_sources(statement: Statement, scenario: Scenario, from_period: date, to_period: date, data_version: str,
+                      entities: tuple[str, ...] | None=None) -> pl.LazyFrame:
+    """Gather the lines a statement is built from for a scenario, labelled with a scenario column."""
+    if statement == Statement.CASH_FLOW_STATEMENT:
+        lf = cash_flow_sources(from_period, to_period, data_version, entities, scenario)
+    else:
+        lf = data_loader.scan_scenario(partial(data_loader.scan_trial_balance, from_period, to_period), scenario, entities)
+    return lf.with_columns(pl.lit(scenario.value).alias("scenario"))
+
+
+def build_statement(statement: Statement, from_period: date, to_period: date, data_version: str,
+                    entities: tuple[str, ...] | None=None, scenario: Scenario=Scenario.ACTUAL) -> pl.DataFrame:
+    """
+    Build a statement of a scenario (actuals by default) for a period range (inclusive) consolidating some entities
+    (all by default), memoized per data version in the shared cache. Callers pass the scenario store's
+    data_loader.data_version() so a new store misses.
+    Frames are shared across sessions so callers must not mutate them in place.
+    """
+    def build() -> pl.DataFrame:
+        lf = statement_sources(statement, scenario, from_period, to_period, data_version, entities)
+        return build_layout(lf, STATEMENT_LAYOUTS[statement], from_period, to_period)
+
+    return shared_cache.get_or_compute("statements", (statement, scenario, from_period, to_period, entities), data_version, build)
+
+
+def build_variance_statement(statement: Statement, scenario: Scenario, from_period: date, to_period: date,
+                             data_versions: tuple[str, str], entities: tuple[str, ...] | None=None) -> pl.DataFrame:
+    """
+    Compare a statement's actuals for a period range (inclusive) with a budget or forecast: a row per account and
+    subtotal with actual, plan, variance and variance % columns (the plan column is named by the scenario), memoized
+    per the versions of both stores (data_loader.scenario_versions). Flows are totalled over the range and balances
+    taken at its end. Both scenarios are aggregated in one pass, pivoted on scenario instead of period.
+    """
+    def build() -> pl.DataFrame:
+        layout = STATEMENT_LAYOUTS[statement]
+        range_start = to_period if layout["values"] == "closing_balance" else from_period
+        lf = pl.concat([
+            statement_sources(statement, statement_scenario, range_start, to_period, data_version, entities)
+            for statement_scenario, data_version in zip([Scenario.ACTUAL, scenario], data_versions)
+        ])
+        df = build_layout(lf, layout, range_start, to_period, "scenario")
+
+        # Accounts missing from one scenario count as zero; a scenario without any rows has no column at all
+        actual, plan = [
+            pl.col(column_scenario.value).fill_null(0) if column_scenario.value in df.columns else pl.lit(0.0)
+            for column_scenario in [Scenario.ACTUAL, scenario]
+        ]
+        return df.select(
+            "gl_account_code",
+            "gl_account_description",
+            actual.alias(Scenario.ACTUAL.value),
+            plan.alias(scenario.value),
+            metrics.variance(actual, plan).alias(VARIANCE_COLUMN),
+            metrics.variance_ratio(actual, plan).alias(VARIANCE_RATIO_COLUMN),
+            "is_subtotal"
+        )
+
+    return shared_cache.get_or_compute("variance statements", (statement, scenario, from_period, to_period, entities), data_versions, build)
+
+
+def drill_down_accounts(statement: Statement, row: dict, entities: tuple[str, ...] | None=None) -> list[str]:
+    """
+    Return the GL account codes behind a row of a statement in DRILL_DOWN_STATEMENTS: the row's own account, or every
+    account in the classes a subtotal is calculated from (looked up in the account index).
+    """
+    if not row["is_subtotal"]:
+        return [row["gl_account_code"]]
+
+    layout = STATEMENT_LAYOUTS[statement]
+    position = next(position for position, section in enumerate(layout["sections"]) if section["subtotal"].value == row["gl_account_description"])
+    classes = [class_value for class_value, coefficient in subtotal_coefficients(layout)[position].items() if coefficient]
+    return data_loader.fetch_account_index(entities).filter(pl.col("account_class").is_in(classes))["gl_account_code"].to_list()
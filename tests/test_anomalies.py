@@ -0,0 +1,28 @@
+from datetime import date
+
+import polars as pl
+
+import anomalies
+from constants import AnomalyRule
+
+
+def activity(amounts: dict[date, float]) -> pl.DataFrame:
+    """The activity of one account in some periods."""
+    return pl.DataFrame({
+        "entity": "Main",
+        "period": list(amounts),
+        "gl_account_code": "6010",
+        "gl_account_description": "Salaries",
+        "activity": list(amounts.values())
+    })
+
+
+def test_z_score_window_drops_history_before_a_gap():
+    history = {date(2020, month, 1): 10000.0 + 100.0 * (month % 3) for month in range(1, 9)}
+    # Back after more than ANOMALY_WINDOW_MONTHS without activity, so there is no history to score against
+    flagged = anomalies.detect_anomalies(activity(history | {date(2022, 1, 1): 90000.0}))
+    assert flagged.filter(pl.col("rule") == AnomalyRule.Z_SCORE.value).is_empty()
+
+    # The same jump the month after the history is flagged
+    flagged = anomalies.detect_anomalies(activity(history | {date(2020, 9, 1): 90000.0}))
+    assert flagged.filter(pl.col("rule") == AnomalyRule.Z_SCORE.value)["period"].to_list() == [date(2020, 9, 1)]
@@ -0,0 +1,72 @@
+import sqlite3
+from datetime import date
+
+import polars as pl
+
+import connectors
+import data_loader
+from connectors import TRIAL_BALANCE_SCHEMA
+
+
+ACCOUNTS = {"1010": "Cash", "4010": "Product Sales", "6010": "Salaries"}
+
+
+def trial_balance(periods: list[date]) -> pl.DataFrame:
+    """A balanced trial balance: cash debited with sales and credited with salaries in every period."""
+    rows = []
+    for number, period in enumerate(periods, start=1):
+        for code, debit, credit in [("1010", 1000.0 * number, 400.0), ("4010", 0.0, 1000.0 * number), ("6010", 400.0, 0.0)]:
+            rows.append({
+                "period": period.isoformat(),
+                "gl_account_code": code,
+                "gl_account_description": ACCOUNTS[code],
+                "beginning_balance": 0.0,
+                "debit": debit,
+                "credit": credit,
+                "closing_balance": debit - credit,
+                "activity": debit - credit
+            })
+    return pl.DataFrame(rows)
+
+
+def insert(path: str, df: pl.DataFrame):
+    with sqlite3.connect(path) as connection:
+        columns = ", ".join(df.columns)
+        connection.execute(f"CREATE TABLE IF NOT EXISTS trial_balance ({columns})")
+        connection.executemany(f"INSERT INTO trial_balance VALUES ({', '.join('?' * len(df.columns))})", df.rows())
+
+
+def stored_rows(store: str) -> pl.DataFrame:
+    return data_loader.scan_trial_balance(store=store).select(list(TRIAL_BALANCE_SCHEMA)).sort("period", "gl_account_code").collect()
+
+
+def test_sqlite_refresh_pulls_only_from_the_high_water_mark(tmp_path, monkeypatch):
+    database, store = tmp_path / "ledger.db", str(tmp_path / "store")
+    source = f"sqlite:///{database}"
+    insert(database, trial_balance([date(2025, 1, 1), date(2025, 2, 1), date(2025, 3, 1)]))
+
+    assert data_loader.current_snapshot(source, store)["high_water_mark"] == "2025-03-01"
+
+    # Record every pull from the database
+    pulls = []
+    scan = connectors.DatabaseConnector.scan
+    def recording_scan(self, from_period=None, to_period=None, account_classes=None):
+        df = scan(self, from_period, to_period, account_classes).collect()
+        pulls.append((from_period, df.height))
+        return df.lazy()
+    monkeypatch.setattr(connectors.DatabaseConnector, "scan", recording_scan)
+
+    assert not data_loader.refresh(source, store)
+    assert pulls == []
+
+    insert(database, trial_balance([date(2025, 4, 1)]))
+    assert data_loader.refresh(source, store)
+    # The latest ingested period (which may still have been open) and the new one, not the closed periods before them
+    assert pulls == [(date(2025, 3, 1), 2 * len(ACCOUNTS))]
+    assert data_loader.current_snapshot(source, store)["high_water_mark"] == "2025-04-01"
+
+    # The same store as a full rebuild
+    monkeypatch.setattr(connectors.DatabaseConnector, "scan", scan)
+    rebuilt = str(tmp_path / "rebuilt")
+    data_loader.ingest_trial_balance(source, rebuilt)
+    assert stored_rows(store).equals(stored_rows(rebuilt))
@@ -0,0 +1,48 @@
+from datetime import date
+
+import polars as pl
+
+import data_loader
+import metrics
+from constants import Comparison, Metric, MetricBasis, Scenario
+
+
+def trial_balance(revenue_by_entity: dict[str, float], period: date=date(2025, 1, 1)) -> pl.DataFrame:
+    """A balanced trial balance of one period: each entity's revenue received in cash."""
+    rows = []
+    for entity, revenue in revenue_by_entity.items():
+        for code, description, debit, credit in [("1010", "Cash", revenue, 0.0), ("4010", "Product Sales", 0.0, revenue)]:
+            rows.append({
+                "entity": entity,
+                "period": period.isoformat(),
+                "gl_account_code": code,
+                "gl_account_description": description,
+                "beginning_balance": 0.0,
+                "debit": debit,
+                "credit": credit,
+                "closing_balance": debit - credit,
+                "activity": debit - credit
+            })
+    return pl.DataFrame(rows)
+
+
+def test_plan_covering_some_selected_entities(tmp_path, monkeypatch):
+    for scenario, revenue_by_entity in [
+        (Scenario.ACTUAL, {"E000": 100.0, "E001": 200.0, "E002": 300.0}),
+        (Scenario.BUDGET, {"E000": 90.0, "E001": 180.0})
+    ]:
+        source = str(tmp_path / f"{scenario.name.lower()}.csv")
+        trial_balance(revenue_by_entity).write_csv(source)
+        monkeypatch.setitem(data_loader.SCENARIO_LOCATIONS, scenario, {"source": source, "store": str(tmp_path / scenario.name.lower())})
+
+    # E002 has no budget, so only E000's is compared with
+    budget = data_loader.scan_scenario(data_loader.scan_rollup, Scenario.BUDGET, ("E000", "E002")).collect()
+    assert set(budget["entity"]) == {"E000"}
+
+    lf = data_loader.scan_scenarios(data_loader.scan_rollup, [Scenario.ACTUAL, Scenario.BUDGET], ("E000", "E002"))
+    summary = metrics.summarize_period(lf, date(2025, 1, 1), MetricBasis.MONTH, Comparison.BUDGET)
+    assert summary[Metric.REVENUE]["value"] == 400.0
+    assert summary[Metric.REVENUE]["delta"] == 400.0 - 90.0
+
+    # No selected entity has a budget
+    assert data_loader.scan_scenario(data_loader.scan_rollup, Scenario.BUDGET, ("E002",)).collect().is_empty()
@@ -0,0 +1,42 @@
+from datetime import date
+
+import polars as pl
+
+import metrics
+from constants import AccountClass, Comparison, Metric, MetricBasis
+
+
+def rollup(periods: list[date]) -> pl.LazyFrame:
+    """A rollup with the same revenue and operating expenses in every period."""
+    return pl.LazyFrame({
+        "period": [period for period in periods for _ in range(2)],
+        "account_class": [AccountClass.REVENUE.value, AccountClass.OPERATING_EXPENSES.value] * len(periods),
+        "activity": [-1000.0, 400.0] * len(periods)
+    })
+
+
+def test_prior_year_without_history_has_no_change():
+    periods = [date(2025, month, 1) for month in range(1, 7)]
+    for basis in [MetricBasis.MONTH, MetricBasis.YEAR_TO_DATE]:
+        summary = metrics.summarize_period(rollup(periods), date(2025, 6, 1), basis, Comparison.PRIOR_YEAR)
+        assert summary[Metric.REVENUE]["value"] is not None
+        assert summary[Metric.REVENUE]["delta"] is None
+        assert summary[Metric.REVENUE]["delta_ratio"] is None
+
+
+def test_prior_month_change():
+    periods = [date(2025, month, 1) for month in range(1, 7)]
+    summary = metrics.summarize_period(rollup(periods), date(2025, 6, 1), MetricBasis.MONTH, Comparison.PRIOR_MONTH)
+    assert summary[Metric.REVENUE] == {"value": 1000.0, "delta": 0.0, "delta_ratio": 0.0}
+    assert summary[Metric.NET_PROFIT]["value"] == 600.0
+
+
+def test_missing_month_has_no_monthly_metrics():
+    metrics_df = metrics.calculate_metrics(rollup([date(2025, month, 1) for month in [1, 2, 4]]))
+    def lookup(basis: MetricBasis, period: date) -> dict[Metric, float | None]:
+        return metrics.period_metrics(metrics_df.filter(pl.col("basis") == basis.value), period)
+
+    assert lookup(MetricBasis.MONTH, date(2025, 3, 1)) == {metric: None for metric in Metric}
+    assert lookup(MetricBasis.MONTH, date(2025, 4, 1))[Metric.REVENUE] == 1000.0
+    # Cumulative totals carry on through the missing month
+    assert lookup(MetricBasis.YEAR_TO_DATE, date(2025, 3, 1))[Metric.REVENUE] == 2000.0
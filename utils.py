@@ -5,8 +5,19 @@ Author: Yakir Havin
 """
 
 
-import streamlit as st
+from contextlib import contextmanager
+from zoneinfo import ZoneInfo
+
+import numpy as np
 import polars as pl
+import streamlit as st
+from streamlit.delta_generator import DeltaGenerator
+
+import data_loader
+import instrumentation
+import shared_cache
+import validation
+from constants import Scenario, PLAN_SCENARIOS, SHARED_CACHE_MAX_BYTES, VALIDATION_DISPLAY_MAX_ROWS
 
 
 def calculate_category_total(df: pl.DataFrame, category: str, value_column: str="activity"):
@@ -14,13 +25,158 @@ def calculate_category_total(df: pl.DataFrame, category: str, value_column: str=
     return df.filter(pl.col("category").str.to_lowercase() == category.lower()).select(pl.col(value_column).sum()).item()
 
 
-def highlight_subtotal_row(row: pl.Series, index: str, highlight_rows: list[str], highlight_color: str="#f5f5f5") -> list[str]:
-    """Apply shading to a subtotal row in a DataFrame."""
-    if row[index] in highlight_rows:
-        return [f"background-color: {highlight_color};"] * len(row)
-    else:
-        return [f'background-color: {st.get_option("theme.backgroundColor")}'] * len(row)
-    
+def highlight_subtotal_rows(df: pl.DataFrame, subtotal_column: str="is_subtotal", highlight_color: str="#f5f5f5",
+                            flagged_cells: pl.DataFrame | None=None, flag_color: str="#fdebc8"):
+    """
+    Apply shading to subtotal rows in a DataFrame, flagged by a boolean column (which is dropped), and to flagged cells
+    given as a frame of booleans shaped like the displayed one (e.g. anomalies.flag_cells).
+    Styles come from one vectorized mask and the pandas frame is Arrow-backed, so numeric columns aren't copied.
+    """
+    display_df = df.drop(subtotal_column)
+    with instrumentation.stage("to pandas") as record:
+        pandas_df = display_df.to_pandas(use_pyarrow_extension_array=True)
+        record["rows"] = len(pandas_df)
+    with instrumentation.stage("styling") as record:
+        row_styles = np.where(df[subtotal_column].to_numpy()[:, None], f"background-color: {highlight_color};", "")
+        styles = np.broadcast_to(row_styles, display_df.shape)
+        if flagged_cells is not None:
+            styles = np.where(flagged_cells.to_numpy(), f"background-color: {flag_color};", styles)
+        styled_df = pandas_df.style.apply(lambda _: styles, axis=None)
+        record["rows"] = len(pandas_df)
+    return styled_df
+
+
+def format_compact(value: float) -> str:
+    """Format a signed amount compactly, like st.metric's compact format (e.g. +1.2K)."""
+    for threshold, suffix in [(1e12, "T"), (1e9, "B"), (1e6, "M"), (1e3, "K")]:
+        if abs(value) >= threshold:
+            return f"{value / threshold:+.1f}{suffix}"
+    return f"{value:+.0f}"
+
+
+def session_cached(name: str, fetch):
+    """Return a value derived from the data, such as the period list, computing it once per session and data version."""
+    version = data_loader.data_version()
+    cached = st.session_state.get(name)
+    if cached is None or cached["version"] != version:
+        cached = st.session_state[name] = {"version": version, "value": fetch()}
+    return cached["value"]
+
+
+@contextmanager
+def page_run(name: str):
+    """
+    Run a page's fragment on one pinned snapshot, recording its stage timings and showing them to admins at the end.
+    Pages put their controls and sections in fragments (nested along which sections depend on which controls), so a
+    control change reruns only the sections that use it, without the rest of the page or the app's navigation.
+    Within an enclosing fragment's run, a nested fragment's stages are part of that run.
+    """
+    with data_loader.pin_snapshot():
+        if instrumentation.active():
+            yield
+            return
+        instrumentation.start_run(name)
+        try:
+            yield
+        finally:
+            run = instrumentation.finish_run()
+        if st.session_state.get("is_admin", False):
+            run_timings_section(st.container(), run)
+
+
+def select_entities(container: DeltaGenerator) -> tuple[str, ...] | None:
+    """Select the entities to consolidate when there are several (None for all of them)."""
+    entity_options = session_cached("entity_options", data_loader.fetch_entities)
+    if len(entity_options) <= 1:
+        return None
+    return tuple(container.multiselect(
+        label="Entities",
+        options=entity_options,
+        placeholder="All entities (consolidated)"
+    )) or None
+
+
+def select_plan(container: DeltaGenerator) -> Scenario | None:
+    """Select a budget or forecast to compare with, among those available (None for neither)."""
+    plan_options = [scenario for scenario in PLAN_SCENARIOS if data_loader.scenario_available(scenario)]
+    if not plan_options:
+        return None
+    return container.selectbox(
+        label="Compare with plan",
+        options=plan_options,
+        index=None,
+        format_func=lambda x: x.value,
+        placeholder="None"
+    )
+
+
+def data_as_of_section(container: DeltaGenerator):
+    """Show when the trial balance behind the current snapshot was last modified."""
+    container.badge(f"Data as of {data_loader.data_as_of().astimezone(ZoneInfo('America/New_York')):%B %e, %Y at %I:%M %p}", color="grey")
+
+
+def run_timings_section(container: DeltaGenerator, run: dict | None):
+    """
+    Show the stage timings of a finished page run, the shared cache's counters and the memory held by the shared
+    cache next to that held by this session (for admins).
+    """
+    if run is None:
+        return
+    stages_df = pl.DataFrame(
+        run["stages"],
+        schema={"stage": pl.Utf8, "rows": pl.Int64, "seconds": pl.Float64}
+    ).with_columns(
+        (pl.col("seconds") * 1000).alias("milliseconds")
+    ).drop("seconds")
+
+    cache_df = shared_cache.cache_info()
+    shared_bytes = cache_df["bytes"].sum()
+    cache_df = cache_df.with_columns((pl.col("bytes") / 1024).alias("kilobytes")).drop("bytes")
+    session_bytes = shared_cache.estimated_size(st.session_state.to_dict())
+    readers = data_loader.snapshot_readers()
+
+    expander = container.expander(f"Run timings: {run['total_seconds'] * 1000:,.0f} ms")
+    expander.dataframe(stages_df, hide_index=True)
+    expander.dataframe(cache_df, hide_index=True)
+    expander.caption(
+        f"Shared across sessions: {shared_bytes / 1024:,.1f} KB (of {SHARED_CACHE_MAX_BYTES / 1024 ** 2:,.0f} MB). "
+        f"This session: {session_bytes / 1024:,.1f} KB. "
+        f"Snapshots in use: {len(readers)}, by {sum(readers.values())} page runs"
+    )
+
+
+def validation_section(container: DeltaGenerator):
+    """Warn that the trial balance behind the current snapshot failed validation, listing the failing periods and accounts."""
+    failures = data_loader.fetch_validation_failures()
+    if failures.is_empty():
+        return
+
+    expander = container.expander(f"The trial balance failed {failures.height:,} integrity checks", icon=":material/warning:")
+    expander.dataframe(
+        validation.summarize_failures(failures),
+        column_config={
+            "rule": "Rule",
+            "failures": "Failures",
+            "periods": "Periods",
+            "accounts": "Accounts"
+        },
+        hide_index=True
+    )
+    expander.dataframe(
+        failures.head(VALIDATION_DISPLAY_MAX_ROWS),
+        column_config={
+            "rule": "Rule",
+            "entity": "Entity",
+            "period": st.column_config.DateColumn(label="Period", format="MMM YYYY"),
+            "gl_account_code": "Account",
+            "expected": st.column_config.NumberColumn(label="Expected", format="accounting"),
+            "actual": st.column_config.NumberColumn(label="Actual", format="accounting")
+        },
+        hide_index=True
+    )
+    if failures.height > VALIDATION_DISPLAY_MAX_ROWS:
+        expander.caption(f"Showing the first {VALIDATION_DISPLAY_MAX_ROWS:,} failures.")
+
     
 def calculate_dataframe_height(rows, height_per_row=35, extra=3):
     """
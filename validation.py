@@ -0,0 +1,81 @@
+"""
+Trial balance validation.
+
+Author: Yakir Havin
+"""
+
+
+import polars as pl
+
+from constants import ValidationRule, VALIDATION_TOLERANCE
+
+
+RULE_DTYPE = pl.Enum([rule.value for rule in ValidationRule])
+
+FAILURE_SCHEMA = {
+    "rule": RULE_DTYPE,
+    "entity": pl.Utf8,
+    "period": pl.Date,
+    "gl_account_code": pl.Utf8,
+    "expected": pl.Float64,
+    "actual": pl.Float64
+}
+
+
+def rule_check(rule: ValidationRule, expected: pl.Expr, actual: pl.Expr, gl_account_code: pl.Expr=pl.col("gl_account_code")) -> list[pl.Expr]:
+    """Select the columns of a rule's failures from rows holding the amounts it compares."""
+    return [
+        pl.lit(rule.value, dtype=RULE_DTYPE).alias("rule"),
+        pl.col("entity"),
+        pl.col("period"),
+        gl_account_code.cast(pl.Utf8).alias("gl_account_code"),
+        expected.cast(pl.Float64).alias("expected"),
+        actual.cast(pl.Float64).alias("actual")
+    ]
+
+
+def validate_trial_balance(df: pl.DataFrame | pl.LazyFrame, tolerance: float=VALIDATION_TOLERANCE) -> pl.DataFrame:
+    """
+    Check a trial balance (as read by data_loader.read_trial_balance) against every ValidationRule and return one row per
+    failure: the entity, period and account (null for period rules) with the amounts that should have been equal.
+    The rules are planned as a single query, so the frame is read once and the rules run in parallel.
+    Missing amounts fail the rules that use them.
+    """
+    lf = df.lazy().with_columns(pl.col("entity").cast(pl.Utf8))
+    amounts = [
+        lf.select(rule_check(
+            ValidationRule.CLOSING_BALANCE,
+            pl.col("beginning_balance") + pl.col("activity"),
+            pl.col("closing_balance")
+        )),
+        lf.select(rule_check(
+            ValidationRule.ACTIVITY,
+            pl.col("debit") - pl.col("credit"),
+            pl.col("activity")
+        )),
+        lf.group_by("entity", "period").agg(
+            pl.col("debit").sum(),
+            pl.col("credit").sum()
+        ).select(rule_check(
+            ValidationRule.BALANCED_PERIOD,
+            pl.col("debit"),
+            pl.col("credit"),
+            pl.lit(None)
+        ))
+    ]
+    failures = [check.filter(((pl.col("expected") - pl.col("actual")).abs() > tolerance).fill_null(True)) for check in amounts]
+    failures.append(lf.filter(pl.col("account_class").is_null()).select(rule_check(
+        ValidationRule.CLASSIFIED_ACCOUNT,
+        pl.lit(None),
+        pl.lit(None)
+    )))
+    return pl.concat(failures).sort("rule", "entity", "period", "gl_account_code").collect()
+
+
+def summarize_failures(failures: pl.DataFrame) -> pl.DataFrame:
+    """Count the failures of each rule with the number of periods and accounts they affect."""
+    return failures.group_by("rule").agg(
+        pl.len().alias("failures"),
+        pl.col("period").n_unique().alias("periods"),
+        pl.col("gl_account_code").drop_nulls().n_unique().alias("accounts")
+    ).sort("rule")